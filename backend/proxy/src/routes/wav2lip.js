@@ -6,6 +6,8 @@ import fetch from 'cross-fetch';
 
 const WAV2LIP_URL = process.env.WAV2LIP_URL || 'http://localhost:8301';
 
+const isMultipart = (req) => (req.headers['content-type'] || '').startsWith('multipart/form-data');
+
 export const registerWav2LipRoutes = (app) => {
     /**
      * Health check for Wav2Lip service
@@ -24,34 +26,120 @@ export const registerWav2LipRoutes = (app) => {
         }
     });
 
+    /**
+     * Register an avatar once and get the avatar_id to send to /wav2lip/generate
+     * POST body: { avatar_image: base64 }
+     *   or multipart/form-data with an avatar_file part, streamed through untouched.
+     * Response: { avatar_id }
+     */
+    app.post('/wav2lip/avatars', async (req, res) => {
+        try {
+            const headers = {};
+            let body;
+
+            if (isMultipart(req)) {
+                // Binary upload: express did not parse it, so pipe the raw body through
+                headers['Content-Type'] = req.headers['content-type'];
+                if (req.headers['content-length']) {
+                    headers['Content-Length'] = req.headers['content-length'];
+                }
+                body = req;
+            } else {
+                const { avatar_image } = req.body;
+
+                if (!avatar_image) {
+                    return res.status(400).json({
+                        error: 'Missing required field: avatar_image'
+                    });
+                }
+
+                const formData = new URLSearchParams();
+                formData.append('avatar_image', avatar_image);
+
+                headers['Content-Type'] = 'application/x-www-form-urlencoded';
+                body = formData;
+            }
+
+            console.log('[proxy] Registering Wav2Lip avatar');
+            const response = await fetch(`${WAV2LIP_URL}/avatars`, {
+                method: 'POST',
+                headers,
+                body,
+                timeout: 30000, // face detection only
+            });
+
+            const data = await response.json().catch(() => ({}));
+            if (!response.ok) {
+                console.error('[proxy] Wav2Lip avatar registration failed:', data);
+                return res.status(response.status).json({
+                    error: data.detail || 'Wav2Lip avatar registration failed',
+                    status: response.status
+                });
+            }
+
+            res.json(data);
+        } catch (error) {
+            console.error('[proxy] Erro ao registrar avatar Wav2Lip:', error);
+            res.status(500).json({
+                error: 'Internal server error',
+                details: error.message
+            });
+        }
+    });
+
     /**
      * Generate lip-synced video
      * POST body: { avatar_image: base64, audio: base64, quality: "base"|"gan" }
+     *   or multipart/form-data with avatar_file/audio_file parts, streamed through untouched.
+     * Send `Accept: video/mp4` (or response_format=binary) to get the raw MP4 back
+     * instead of base64 JSON. render=overlay returns only the face box video plus
+     * its position (`box` in JSON, X-Overlay-Box header for raw MP4).
      */
     app.post('/wav2lip/generate', async (req, res) => {
         try {
-            const { avatar_image, audio, quality = 'base' } = req.body;
+            const headers = {};
+            let body;
 
-            if (!avatar_image || !audio) {
-                return res.status(400).json({
-                    error: 'Missing required fields: avatar_image, audio'
-                });
-            }
+            if (isMultipart(req)) {
+                // Binary upload: express did not parse it, so pipe the raw body through
+                headers['Content-Type'] = req.headers['content-type'];
+                if (req.headers['content-length']) {
+                    headers['Content-Length'] = req.headers['content-length'];
+                }
+                body = req;
+                console.log('[proxy] Generating lip-sync video (multipart)');
+            } else {
+                const { avatar_image, audio, quality = 'base', avatar_id, response_format, render } = req.body;
+
+                if ((!avatar_image && !avatar_id) || !audio) {
+                    return res.status(400).json({
+                        error: 'Missing required fields: avatar_image (or avatar_id), audio'
+                    });
+                }
 
-            console.log(`[proxy] Generating lip-sync video (quality=${quality})`);
+                console.log(`[proxy] Generating lip-sync video (quality=${quality})`);
 
-            // Create form data
-            const formData = new URLSearchParams();
-            formData.append('avatar_image', avatar_image);
-            formData.append('audio', audio);
-            formData.append('quality', quality);
+                // Create form data
+                const formData = new URLSearchParams();
+                if (avatar_image) formData.append('avatar_image', avatar_image);
+                if (avatar_id) formData.append('avatar_id', avatar_id);
+                formData.append('audio', audio);
+                formData.append('quality', quality);
+                if (response_format) formData.append('response_format', response_format);
+                if (render) formData.append('render', render);
+
+                headers['Content-Type'] = 'application/x-www-form-urlencoded';
+                body = formData;
+            }
+
+            if (req.headers.accept) {
+                headers.Accept = req.headers.accept;
+            }
 
             const response = await fetch(`${WAV2LIP_URL}/generate`, {
                 method: 'POST',
-                headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                },
-                body: formData,
+                headers,
+                body,
                 timeout: 90000, // 90s timeout for CPU processing
             });
 
@@ -64,6 +152,19 @@ export const registerWav2LipRoutes = (app) => {
                 });
             }
 
+            const contentType = response.headers.get('content-type') || '';
+            if (contentType.startsWith('video/')) {
+                // Raw MP4: stream the bytes back without buffering or re-encoding
+                res.status(200);
+                res.set('Content-Type', contentType);
+                const duration = response.headers.get('x-duration-ms');
+                if (duration) res.set('X-Duration-Ms', duration);
+                const overlayBox = response.headers.get('x-overlay-box');
+                if (overlayBox) res.set('X-Overlay-Box', overlayBox);
+                response.body.pipe(res);
+                return;
+            }
+
             const data = await response.json();
             console.log('[proxy] Lip-sync video generated successfully');
             res.json(data);
@@ -23,6 +23,7 @@ const corsOptions = {
   credentials: true,
   methods: ['GET', 'POST', 'OPTIONS'],
   allowedHeaders: ['Content-Type', 'Authorization'],
+  exposedHeaders: ['X-Duration-Ms', 'X-Overlay-Box'],
 };
 
 app.use(cors(corsOptions));
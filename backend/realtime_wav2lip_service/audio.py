@@ -1,3 +1,8 @@
+import io
+import math
+import os
+import tempfile
+import wave
 import librosa
 import librosa.filters
 import numpy as np
@@ -9,6 +14,74 @@ from hparams import hparams as hp
 def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
 
+def load_wav_bytes(buf, sr):
+    """Decode an in-memory audio file to mono float32 at ``sr``, like ``load_wav``.
+
+    WAV/PCM (and anything else libsndfile reads) is decoded without touching
+    the disk. Formats it can't read (e.g. MP3 on older libsndfile builds) fall
+    back to librosa through a temporary file.
+    """
+    try:
+        wav, orig_sr = _decode_audio_bytes(buf)
+    except Exception:
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(buf)
+            path = f.name
+        try:
+            return load_wav(path, sr)
+        finally:
+            os.remove(path)
+
+    if wav.ndim > 1:
+        wav = wav.mean(axis=1)
+    return resample(wav.astype(np.float32), orig_sr, sr)
+
+def _decode_audio_bytes(buf):
+    try:
+        import soundfile as sf
+    except ImportError:
+        return _read_pcm_wav(buf)
+    try:
+        return sf.read(io.BytesIO(buf), dtype='float32')
+    except Exception:
+        return _read_pcm_wav(buf)
+
+def _read_pcm_wav(buf):
+    """Fallback PCM WAV reader based on the standard library."""
+    with wave.open(io.BytesIO(buf)) as w:
+        n_channels, width, sr = w.getnchannels(), w.getsampwidth(), w.getframerate()
+        frames = w.readframes(w.getnframes())
+
+    if width == 1:
+        data = (np.frombuffer(frames, np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        data = np.frombuffer(frames, '<i2').astype(np.float32) / 2**15
+    elif width == 3:
+        # Sign-extend packed 24-bit samples into the top of an int32
+        raw = np.frombuffer(frames, np.uint8).reshape(-1, 3)
+        data = (raw[:, 0].astype(np.int32) << 8 | raw[:, 1].astype(np.int32) << 16
+                | raw[:, 2].astype(np.int32) << 24).astype(np.float32) / 2**31
+    elif width == 4:
+        data = np.frombuffer(frames, '<i4').astype(np.float32) / 2**31
+    else:
+        raise ValueError(f'Unsupported WAV sample width: {width}')
+
+    return data.reshape(-1, n_channels), sr
+
+def resample(wav, orig_sr, target_sr):
+    """Resample with a polyphase filter when the rates have a small integer ratio.
+
+    Covers the usual TTS/browser rates: 48k -> 16k is 1/3, 24k -> 16k is 2/3,
+    44.1k -> 16k is 160/441 and 22.05k -> 16k is 320/441.
+    """
+    if orig_sr == target_sr:
+        return wav
+    g = math.gcd(int(orig_sr), int(target_sr))
+    up, down = int(target_sr) // g, int(orig_sr) // g
+    if max(up, down) > 1000:
+        return librosa.resample(wav, orig_sr=orig_sr, target_sr=target_sr)
+    return signal.resample_poly(wav, up, down).astype(np.float32)
+
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
     #proposed by @dsmiller
@@ -34,6 +107,39 @@ def get_hop_size():
         hop_size = int(hp.frame_shift_ms / 1000 * hp.sample_rate)
     return hop_size
 
+def mel_chunks(mel, fps, mel_step_size=16, pad_last=False, first=0):
+    """All ``mel_step_size``-wide mel windows the generator consumes, one per video frame.
+
+    The windows come from a zero-copy ``sliding_window_view`` over ``mel`` and the
+    fractional hop (80 / fps mel frames per video frame) is applied with a single
+    fancy-index gather, so the result is one contiguous (N, 1, num_mels,
+    mel_step_size) float32 array instead of a list of per-chunk slices.
+
+    With ``pad_last`` a final window aligned to the end of ``mel`` is appended,
+    matching the chunking loop in ``inference.py``; without it trailing audio that
+    does not fill a whole window is dropped.
+
+    ``first`` skips the windows of earlier video frames, which lets a growing
+    (streamed) spectrogram be chunked incrementally.
+    """
+    num_mels, num_frames = mel.shape
+    mel_idx_multiplier = 80. / fps
+    last_start = num_frames - mel_step_size
+    if last_start < 0:
+        return np.empty((0, 1, num_mels, mel_step_size), dtype=np.float32)
+
+    # Same float arithmetic as ``int(i * mel_idx_multiplier)`` in the original loop
+    starts = (np.arange(first, max(first, int(last_start / mel_idx_multiplier) + 2))
+              * mel_idx_multiplier).astype(np.int64)
+    starts = starts[starts <= last_start]
+    if pad_last:
+        starts = np.append(starts, last_start)
+
+    windows = np.lib.stride_tricks.sliding_window_view(
+        mel.astype(np.float32, copy=False), mel_step_size, axis=1)  # (num_mels, W, mel_step_size) view
+    chunks = windows.transpose(1, 0, 2)[starts]  # (N, num_mels, mel_step_size), one allocation
+    return chunks[:, np.newaxis]
+
 def linearspectrogram(wav):
     D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
     S = _amp_to_db(np.abs(D)) - hp.ref_level_db
@@ -44,12 +150,69 @@ def linearspectrogram(wav):
 
 def melspectrogram(wav):
     D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
+    return _stft_to_mel(D)
+
+def _stft_to_mel(D):
     S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
     
     if hp.signal_normalization:
         return _normalize(S)
     return S
 
+class StreamingMel:
+    """Incremental ``melspectrogram`` for audio that arrives in chunks.
+
+    Keeps the preemphasis filter state and the STFT overlap between calls, and
+    zero-pads the start and end like librosa's centered STFT, so concatenating
+    the output of every ``push`` plus ``flush`` gives the same frames as one
+    ``melspectrogram`` call on the whole waveform.
+    """
+
+    def __init__(self):
+        assert not hp.use_lws, 'StreamingMel only supports the librosa STFT'
+        self.n_fft = hp.n_fft
+        self.hop_size = get_hop_size()
+        self.num_samples = 0
+        self.num_frames = 0
+        # State of the preemphasis FIR filter (lfilter zi) carried across chunks
+        self._zi = np.zeros(1)
+        # Preemphasized samples not yet consumed by a full frame, starting with the centering pad
+        self._buffer = np.zeros(self.n_fft // 2)
+        self._finished = False
+
+    def push(self, wav):
+        """Add PCM samples at ``hp.sample_rate``; returns the newly completed (num_mels, T) frames."""
+        if self._finished:
+            raise RuntimeError('StreamingMel already flushed')
+        wav = np.asarray(wav)
+        self.num_samples += len(wav)
+        if hp.preemphasize:
+            wav, self._zi = signal.lfilter([1, -hp.preemphasis], [1], wav, zi=self._zi)
+        self._buffer = np.concatenate((self._buffer, wav))
+        return self._emit()
+
+    def flush(self):
+        """Pad the end of the stream and return the remaining frames."""
+        self._finished = True
+        self._buffer = np.concatenate((self._buffer, np.zeros(self.n_fft // 2)))
+        # A centered STFT has exactly 1 + len(wav) // hop_size frames
+        return self._emit(limit=1 + self.num_samples // self.hop_size - self.num_frames)
+
+    def _emit(self, limit=None):
+        n = 0
+        if len(self._buffer) >= self.n_fft:
+            n = (len(self._buffer) - self.n_fft) // self.hop_size + 1
+        if limit is not None:
+            n = min(n, limit)
+        if n <= 0:
+            return np.empty((hp.num_mels, 0))
+
+        D = librosa.stft(y=self._buffer[:(n - 1) * self.hop_size + self.n_fft], n_fft=self.n_fft,
+                         hop_length=self.hop_size, win_length=hp.win_size, center=False)
+        self._buffer = self._buffer[n * self.hop_size:]
+        self.num_frames += n
+        return _stft_to_mel(D)
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
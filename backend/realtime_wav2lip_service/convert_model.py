@@ -1,6 +1,8 @@
 import torch
 import sys
 import os
+import json
+import argparse
 from pathlib import Path
 import subprocess
 
@@ -16,66 +18,210 @@ except ImportError:
     print("Could not import Wav2Lip model. Check path.")
     sys.exit(1)
 
-def convert():
-    print("Initializing Wav2Lip model...")
-    model = Wav2Lip()
-    
-    checkpoint_path = wav2lip_service_path / "checkpoints" / "wav2lip_gan.pth"
-    
-    if not checkpoint_path.exists():
-        print(f"Checkpoint not found at {checkpoint_path}")
-        sys.exit(1)
-        
+# quality -> checkpoint file name (same names as wav2lip_service)
+CHECKPOINTS = {
+    "base": "wav2lip.pth",
+    "gan": "wav2lip_gan.pth",
+}
+# Read by the realtime service at startup to find the IRs and their shapes
+MANIFEST_NAME = "wav2lip_manifest.json"
+# Marks a dynamic dimension in the manifest shapes
+DYNAMIC = -1
+
+parser = argparse.ArgumentParser(description='Export the Wav2Lip checkpoints to dynamic-batch OpenVINO IRs')
+parser.add_argument('--checkpoints_dir', type=str, default=str(wav2lip_service_path / "checkpoints"),
+                    help='Directory holding wav2lip.pth and/or wav2lip_gan.pth')
+parser.add_argument('--output_dir', type=str, default='.',
+                    help='Where the IRs and the manifest are written')
+parser.add_argument('--quality', type=str, nargs='+', choices=list(CHECKPOINTS), default=list(CHECKPOINTS),
+                    help='Checkpoints to convert (default: all that exist)')
+parser.add_argument('--split', default=False, action='store_true',
+                    help='Also export the face encoder and the decoder as separate graphs, '
+                         'so the service encodes each avatar once and runs only the decoder per batch')
+
+
+class FaceEncoder(torch.nn.Module):
+    """Face-encoder half of Wav2Lip: (N, 6, 96, 96) -> the seven skip features."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, face_sequences):
+        return tuple(self.model.encode_face(face_sequences))
+
+
+class Decoder(torch.nn.Module):
+    """Audio encoder + decoder: (B, 1, 80, 16) mels and cached face features -> (B, 3, 96, 96)."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, audio_sequences, *face_feats):
+        return self.model.decode(audio_sequences, list(face_feats))
+
+
+def load_checkpoint(checkpoint_path):
     print(f"Loading checkpoint from {checkpoint_path}")
+    model = Wav2Lip()
     checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
     s = checkpoint["state_dict"]
     new_s = {}
     for k, v in s.items():
         new_s[k.replace('module.', '')] = v
     model.load_state_dict(new_s)
-    model.eval()
-
-    # Dummy inputs for ONNX export
-    # Audio: (Batch, Channel, Height, Width) -> (1, 1, 80, 16)
-    # Face: (Batch, Channel, Height, Width) -> (1, 6, 96, 96)
-    audio_input = torch.randn(1, 1, 80, 16)
-    face_input = torch.randn(1, 6, 96, 96)
+    return model.eval()
 
-    onnx_path = "wav2lip.onnx"
-    print(f"Exporting to ONNX: {onnx_path}...")
-    torch.onnx.export(
-        model, 
-        (audio_input, face_input), 
-        onnx_path, 
-        verbose=False,
-        input_names=['audio_sequences', 'face_sequences'], 
-        output_names=['outputs'],
-        opset_version=11
-    )
-    print("ONNX export complete.")
 
-    # Convert to OpenVINO
-    print("Converting to OpenVINO IR...")
-    # Using ovc from openvino.tools
-    # Command: ovc wav2lip.onnx --output_model wav2lip_openvino --compress_to_fp16
-    
-    # Find ovc executable or module
-    # We will try running it as a module
+def to_openvino(onnx_path, output_model):
     cmd = [
         sys.executable, "-m", "openvino.tools.ovc",
         onnx_path,
-        "--output_model", "wav2lip_openvino",
+        "--output_model", output_model,
         "--compress_to_fp16"
     ]
-    
+
     print(f"Running: {' '.join(cmd)}")
     try:
         subprocess.check_call(cmd)
-        print("OpenVINO conversion complete.")
-        print("Model saved to wav2lip_openvino.xml and wav2lip_openvino.bin")
+        print(f"Model saved to {output_model}.xml and {output_model}.bin")
     except subprocess.CalledProcessError as e:
         print(f"OpenVINO conversion failed: {e}")
         sys.exit(1)
 
+
+def batch_shape(tensor):
+    """Manifest shape of an example tensor whose batch dimension is dynamic."""
+    return [DYNAMIC] + list(tensor.shape[1:])
+
+
+def export_graph(module, args, output_dir, name, inputs, outputs, dynamic_axes):
+    """Export ``module`` to ONNX and OpenVINO IR and return its manifest entry.
+
+    ``inputs`` and ``outputs`` map tensor names to their example tensors; the
+    axes listed in ``dynamic_axes`` are recorded as dynamic in the manifest.
+    """
+    onnx_path = str(output_dir / f"{name}.onnx")
+    print(f"Exporting to ONNX: {onnx_path}...")
+    torch.onnx.export(
+        module,
+        args,
+        onnx_path,
+        verbose=False,
+        input_names=list(inputs),
+        output_names=list(outputs),
+        dynamic_axes=dynamic_axes,
+        opset_version=11
+    )
+
+    print("Converting to OpenVINO IR...")
+    to_openvino(onnx_path, str(output_dir / name))
+
+    def shapes(tensors):
+        return {tensor_name: batch_shape(tensor) if tensor_name in dynamic_axes else list(tensor.shape)
+                for tensor_name, tensor in tensors.items()}
+
+    return {
+        "xml": f"{name}.xml",
+        "precision": "fp16",
+        "inputs": shapes(inputs),
+        "outputs": shapes(outputs),
+    }
+
+
+def export_full(model, stem, output_dir, audio_input, face_input):
+    """Export the whole generator with a dynamic batch dimension on every input and output."""
+    with torch.no_grad():
+        outputs = model(audio_input, face_input)
+    return export_graph(
+        model, (audio_input, face_input), output_dir, f"{stem}_openvino",
+        inputs={'audio_sequences': audio_input, 'face_sequences': face_input},
+        outputs={'outputs': outputs},
+        dynamic_axes={name: {0: "batch"} for name in ('audio_sequences', 'face_sequences', 'outputs')}
+    )
+
+
+def export_split(model, stem, output_dir, audio_input, face_input):
+    """Export the face encoder and the decoder as two graphs.
+
+    The service runs the face encoder once per avatar and the decoder per
+    batch, with the avatar's features (batch 1) broadcast over the mel batch.
+    The audio encoder stays inside the decoder graph: every mel window is
+    used exactly once, so there is nothing to cache between its output and
+    the decoder.
+    """
+    with torch.no_grad():
+        face_feats = model.encode_face(face_input)
+        outputs = model.decode(audio_input, face_feats)
+    feats = {f"face_feat_{i}": feat for i, feat in enumerate(face_feats)}
+
+    face_encoder = export_graph(
+        FaceEncoder(model), (face_input,), output_dir, f"{stem}_face_encoder",
+        inputs={'face_sequences': face_input},
+        outputs=feats,
+        dynamic_axes={name: {0: "batch"} for name in ['face_sequences'] + list(feats)}
+    )
+    decoder = export_graph(
+        Decoder(model), (audio_input, *face_feats), output_dir, f"{stem}_decoder",
+        inputs={'audio_sequences': audio_input, **feats},
+        outputs={'outputs': outputs},
+        # Features may come with batch 1 (one avatar) or the full audio batch
+        dynamic_axes={
+            'audio_sequences': {0: "batch"},
+            'outputs': {0: "batch"},
+            **{name: {0: "face_batch"} for name in feats},
+        }
+    )
+    return {"face_encoder": face_encoder, "decoder": decoder}
+
+
+def read_manifest(path):
+    if path.exists():
+        with open(path) as f:
+            return json.load(f)
+    return {"models": {}}
+
+
+def convert(args):
+    checkpoints_dir = Path(args.checkpoints_dir)
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Other qualities already in the manifest are kept, so checkpoints can be converted one at a time
+    manifest_path = output_dir / MANIFEST_NAME
+    manifest = read_manifest(manifest_path)
+
+    # Dummy inputs for ONNX export
+    # Audio: (Batch, Channel, Height, Width) -> (1, 1, 80, 16)
+    # Face: (Batch, Channel, Height, Width) -> (1, 6, 96, 96)
+    audio_input = torch.randn(1, 1, 80, 16)
+    face_input = torch.randn(1, 6, 96, 96)
+
+    converted = 0
+    for quality in args.quality:
+        checkpoint = CHECKPOINTS[quality]
+        checkpoint_path = checkpoints_dir / checkpoint
+        if not checkpoint_path.exists():
+            print(f"Checkpoint not found at {checkpoint_path}, skipping quality '{quality}'")
+            continue
+
+        model = load_checkpoint(checkpoint_path)
+        stem = Path(checkpoint).stem
+        entry = {"checkpoint": checkpoint, "full": export_full(model, stem, output_dir, audio_input, face_input)}
+        if args.split:
+            # Static avatars: face encoder once per avatar, decoder per batch
+            entry.update(export_split(model, stem, output_dir, audio_input, face_input))
+        manifest["models"][quality] = entry
+        converted += 1
+
+    if converted == 0:
+        print(f"No checkpoints converted from {checkpoints_dir}")
+        sys.exit(1)
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Manifest written to {manifest_path} ({', '.join(manifest['models'])})")
+
 if __name__ == "__main__":
-    convert()
+    convert(parser.parse_args())
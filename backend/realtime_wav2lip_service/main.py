@@ -5,16 +5,23 @@ import base64
 import numpy as np
 import cv2
 import openvino.runtime as ov
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import uvicorn
 import io
-import tempfile
+import struct
+import threading
+from collections import namedtuple
 from pathlib import Path
+from typing import Optional
 
 # Import audio processing
 import audio
+from avatar_cache import AvatarCache
+from video_encoder import FFmpegEncoder
+from wav2lip_models import Wav2LipModel, face_sequence, legacy_entry, load_manifest
 
 app = FastAPI()
 
@@ -24,225 +31,538 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Duration-Ms"],
 )
 
 # Load OpenVINO Model
+# Written by convert_model.py: every quality's IRs and their shapes
+MANIFEST_PATH = os.getenv("WAV2LIP_MANIFEST", "wav2lip_manifest.json")
+# Used for every quality when there is no manifest
 MODEL_PATH = "wav2lip_openvino.xml"
+# Name the MODEL_PATH IR is loaded under
+LEGACY_QUALITY = "default"
+# Number of mel chunks stacked into one inference call (e.g. 16/32/64)
+BATCH_SIZE = max(1, int(os.getenv("WAV2LIP_BATCH_SIZE", "32")))
+# Number of infer requests kept alive and shared between concurrent requests
+# (0: OPTIMAL_NUMBER_OF_INFER_REQUESTS of the compiled model, i.e. one per stream)
+NUM_INFER_REQUESTS = max(0, int(os.getenv("WAV2LIP_INFER_REQUESTS", "0")))
+# "LATENCY": all cores on one inference at a time (single session);
+# "THROUGHPUT": cores split into streams serving many sessions in parallel
+PERFORMANCE_HINT = os.getenv("WAV2LIP_PERFORMANCE_HINT", "LATENCY").upper()
+# CPU streams, e.g. "4" or "AUTO" (empty: derived from the hint)
+NUM_STREAMS = os.getenv("WAV2LIP_NUM_STREAMS", "")
+# Threads used for inference across all streams (0: all available cores)
+INFERENCE_THREADS = max(0, int(os.getenv("WAV2LIP_INFERENCE_THREADS", "0")))
+# Pin inference threads to cores: "true"/"false" (empty: plugin default)
+CPU_PINNING = os.getenv("WAV2LIP_CPU_PINNING", "").lower()
+# "sync": one blocking infer request per call; "async": pipelined AsyncInferQueue
+INFERENCE_MODE = os.getenv("WAV2LIP_INFERENCE_MODE", "sync").lower()
+# Parallel jobs in the AsyncInferQueue (0 lets OpenVINO pick the optimal number)
+ASYNC_JOBS = max(0, int(os.getenv("WAV2LIP_ASYNC_JOBS", "0")))
+FPS = 25
+MEL_STEP_SIZE = 16
+# Preprocessed avatars kept in memory (LRU)
+AVATAR_CACHE_SIZE = int(os.getenv("AVATAR_CACHE_SIZE", "32"))
+# Frame encodings offered by the /wav2lip/stream WebSocket
+STREAM_FORMATS = ("jpeg", "raw")
+STREAM_JPEG_QUALITY = int(os.getenv("WAV2LIP_STREAM_JPEG_QUALITY", "90"))
+# OpenVINO compiled-model cache, so restarts and new replicas skip compilation ("" disables it)
+CACHE_DIR = os.getenv("WAV2LIP_CACHE_DIR", "model_cache")
+# Batch sizes every infer request runs once at startup (default: 1, BATCH_SIZE / 4 and BATCH_SIZE)
+WARMUP_BATCH_SIZES = [int(b) for b in os.getenv(
+    "WAV2LIP_WARMUP_BATCH_SIZES", f"1,{max(1, BATCH_SIZE // 4)},{BATCH_SIZE}").split(",") if b.strip()]
+
 core = ov.Core()
-compiled_model = None
-input_layer_audio = None
-input_layer_face = None
-output_layer = None
+if CACHE_DIR:
+    core.set_property({"CACHE_DIR": CACHE_DIR})
+# quality -> Wav2LipModel, published once every model is compiled
+models = {}
+# "loading" -> "warming" -> "ready", or "failed" when no model could be loaded
+service_state = "loading"
+startup_times = {}
+avatar_cache = AvatarCache(AVATAR_CACHE_SIZE)
+
+# Cached per avatar: face_seq - (1, 6, 96, 96) masked+reference face input,
+# face_feats - quality -> face-encoder features (split graphs only), filled in on first use
+PreparedAvatar = namedtuple("PreparedAvatar", ["face_seq", "face_feats"])
+
+def compile_config():
+    """OpenVINO CPU properties from the WAV2LIP_* environment variables."""
+    config = {"PERFORMANCE_HINT": PERFORMANCE_HINT}
+    if NUM_STREAMS:
+        config["NUM_STREAMS"] = NUM_STREAMS
+    if INFERENCE_THREADS:
+        config["INFERENCE_NUM_THREADS"] = str(INFERENCE_THREADS)
+    if CPU_PINNING:
+        config["ENABLE_CPU_PINNING"] = "YES" if CPU_PINNING in ("1", "true", "yes") else "NO"
+    return config
 
 def load_model():
-    global compiled_model, input_layer_audio, input_layer_face, output_layer
-    if not os.path.exists(MODEL_PATH):
-        print(f"Model not found: {MODEL_PATH}")
+    global models
+    if os.path.exists(MANIFEST_PATH):
+        entries = load_manifest(MANIFEST_PATH)
+    elif os.path.exists(MODEL_PATH):
+        print(f"No manifest at {MANIFEST_PATH}, serving every quality with {MODEL_PATH}")
+        entries = {LEGACY_QUALITY: legacy_entry(MODEL_PATH)}
+    else:
+        print(f"Model not found: {MANIFEST_PATH} or {MODEL_PATH}")
         return
-    
-    print("Loading OpenVINO model...")
-    model = core.read_model(model=MODEL_PATH)
-    # Compile for CPU (or GPU if available/configured, but user has CPU)
-    compiled_model = core.compile_model(model=model, device_name="CPU")
-    
-    # Get input/output layers
-    # Note: Names might vary depending on export. We use index or name if known.
-    # In export script we named them: 'audio_sequences', 'face_sequences', 'outputs'
+
+    loaded = {}
+    config = compile_config()
+    print(f"Compile properties: {config}")
+    async_jobs = ASYNC_JOBS if INFERENCE_MODE == "async" else None
+    for quality, entry in entries.items():
+        print(f"Loading OpenVINO model '{quality}'...")
+        model = Wav2LipModel(quality, entry)
+        try:
+            # Compile for CPU (or GPU if available/configured, but user has CPU)
+            model.load(core, "CPU", BATCH_SIZE, NUM_INFER_REQUESTS, async_jobs, on_async_batch_done, config)
+        except Exception as e:
+            print(f"Could not load model '{quality}': {e}")
+            continue
+        loaded[quality] = model
+
+        if model.async_queue is not None:
+            print(f"Async pipeline enabled with {len(model.async_queue)} parallel infer request(s).")
+        print(f"Model '{quality}' loaded successfully in {model.compile_time:.2f}s "
+              f"({'split graphs' if model.split else 'full graph'}, "
+              f"batch size {model.max_batch_size}, {model.num_infer_requests} infer request(s)).")
+    models = loaded
+
+def warm_up():
+    for quality, model in models.items():
+        model.warm_up(WARMUP_BATCH_SIZES)
+        print(f"Model '{quality}' warmed up in {model.warmup_time:.2f}s (batch sizes {WARMUP_BATCH_SIZES}).")
+
+def start_service():
+    """Compile and warm up every model; /health reports the progress."""
+    global service_state
+    start = time.perf_counter()
     try:
-        input_layer_audio = compiled_model.input("audio_sequences")
-        input_layer_face = compiled_model.input("face_sequences")
-        output_layer = compiled_model.output("outputs")
+        load_model()
+        startup_times["compile_s"] = round(time.perf_counter() - start, 3)
+        if not models:
+            service_state = "failed"
+            return
+
+        service_state = "warming"
+        warm_start = time.perf_counter()
+        warm_up()
+        startup_times["warmup_s"] = round(time.perf_counter() - warm_start, 3)
+        service_state = "ready"
     except Exception as e:
-        print(f"Error getting layers by name: {e}. Trying by index.")
-        input_layer_audio = compiled_model.input(0)
-        input_layer_face = compiled_model.input(1)
-        output_layer = compiled_model.output(0)
-        
-    print("Model loaded successfully.")
+        print(f"Startup failed: {e}")
+        service_state = "failed"
+    startup_times["total_s"] = round(time.perf_counter() - start, 3)
+
+def select_model(quality):
+    """Model for a request's ``quality``; without a manifest the legacy IR serves every quality."""
+    if service_state in ("loading", "warming"):
+        raise HTTPException(status_code=503, detail=f"Model {service_state}, retry shortly")
+    if not models:
+        raise HTTPException(status_code=500, detail="Model not loaded")
+    if LEGACY_QUALITY in models:
+        return models[LEGACY_QUALITY]
+    model = models.get(quality)
+    if model is None:
+        raise HTTPException(status_code=400, detail=f"Unknown quality '{quality}', available: {', '.join(models)}")
+    return model
+
+def to_frames(res, out):
+    """Convert a (B, 3, 96, 96) float output in [0, 1] into uint8 frames in ``out``."""
+    np.multiply(res.transpose(0, 2, 3, 1), 255.0, out=out, casting="unsafe")
+
+def iter_batched_inference(model, mel_chunks, avatar):
+    """Run the generator over all mel chunks, ``model.max_batch_size`` chunks per call.
+
+    Yields ``(start, frames)`` per batch in chunk order, where ``frames`` is a
+    (B, 96, 96, 3) uint8 array for chunks ``start .. start + B``.
+    """
+    batch_size = min(model.max_batch_size, len(mel_chunks))
+    face_inputs = model.face_inputs(avatar, batch_size)
+
+    for start in range(0, len(mel_chunks), batch_size):
+        m = mel_chunks[start : start + batch_size]
+        frames = np.empty((len(m), 96, 96, 3), dtype=np.uint8)
+        # Borrowed per batch and returned before yielding: the consumer may wait on a
+        # slow WebSocket client between batches, and must not hold up other requests
+        with model.acquire_infer_request() as request:
+            request.infer(model.batch_inputs(m, face_inputs))
+            to_frames(request.get_tensor(model.output).data, frames)
+        yield start, frames
+
+def run_batched_inference(model, mel_chunks, avatar):
+    """Returns a (N, 96, 96, 3) uint8 array of frames in chunk order."""
+    result_frames = np.empty((len(mel_chunks), 96, 96, 3), dtype=np.uint8)
+    for start, frames in iter_batched_inference(model, mel_chunks, avatar):
+        result_frames[start : start + len(frames)] = frames
+    return result_frames
+
+class PipelineJob:
+    """Tracks the batches of one request that are in flight on the async queue."""
+
+    def __init__(self, num_frames, num_batches):
+        self.frames = np.empty((num_frames, 96, 96, 3), dtype=np.uint8)
+        self.remaining = num_batches
+        self.error = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def batch_finished(self, error=None):
+        with self.lock:
+            if error is not None and self.error is None:
+                self.error = error
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.done.set()
+
+def on_async_batch_done(request, userdata):
+    """AsyncInferQueue callback: convert the finished batch straight into the job's frames."""
+    job, output, start, count = userdata
+    try:
+        to_frames(request.get_tensor(output).data, job.frames[start : start + count])
+    except Exception as e:
+        job.batch_finished(e)
+        return
+    job.batch_finished()
+
+def run_pipelined_inference(model, mel_chunks, avatar):
+    """Same contract as ``run_batched_inference`` but overlaps pre/post-processing
+    with inference by keeping several batches in flight on the AsyncInferQueue.
+    """
+    batch_size = min(model.max_batch_size, len(mel_chunks))
+    face_inputs = model.face_inputs(avatar, batch_size)
+    starts = range(0, len(mel_chunks), batch_size)
+
+    job = PipelineJob(len(mel_chunks), len(starts))
+    # start_async copies the inputs and blocks only until a request is idle;
+    # the lock keeps concurrent HTTP requests from interleaving submissions
+    with model.async_submit_lock:
+        for start in starts:
+            m = mel_chunks[start : start + batch_size]
+            model.async_queue.start_async(model.batch_inputs(m, face_inputs), (job, model.output, start, len(m)))
+
+    job.done.wait()
+    if job.error is not None:
+        raise job.error
+    return job.frames
+
+def infer_frames(model, mel_chunks, avatar):
+    if model.async_queue is not None:
+        return run_pipelined_inference(model, mel_chunks, avatar)
+    return run_batched_inference(model, mel_chunks, avatar)
+
+def decode_base64_field(value):
+    """Decode a Base64 form field, dropping a data URL header if present."""
+    if "base64," in value:
+        value = value.split("base64,")[1]
+    return base64.b64decode(value)
+
+def prepare_avatar(image_bytes):
+    """Decode an avatar image and build its PreparedAvatar with the (1, 6, 96, 96) masked face input."""
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    
+    if frame is None:
+        raise ValueError("Invalid image")
+
+    return PreparedAvatar(face_sequence(frame), {})
+
+def read_input(upload, base64_value):
+    """Bytes of a form input sent either as a multipart file or as a legacy Base64 field."""
+    if upload is not None:
+        return upload.file.read()
+    if base64_value:
+        return decode_base64_field(base64_value)
+    return None
+
+def wants_binary_response(request, response_format):
+    """Raw video/mp4 when asked for explicitly or via the Accept header, JSON + Base64 otherwise."""
+    if response_format:
+        return response_format == "binary"
+    return "video/mp4" in request.headers.get("accept", "")
+
+def resolve_avatar(image_bytes, avatar_id):
+    """Return the PreparedAvatar for a registered avatar ID or an encoded image (cached by content hash)."""
+    if avatar_id:
+        avatar = avatar_cache.get(avatar_id)
+        if avatar is None:
+            raise HTTPException(status_code=404, detail="Unknown avatar_id, register the avatar again")
+        return avatar
+    if image_bytes:
+        _, avatar = avatar_cache.get_or_create(image_bytes, prepare_avatar)
+        return avatar
+    raise HTTPException(status_code=400, detail="Either avatar_image or avatar_id is required")
+
+def mel_chunks_from_wav(wav):
+    """Split the mel spectrogram of ``wav`` into one (1, 80, 16) window per video frame."""
+    mel = audio.melspectrogram(wav)
+    
+    if np.isnan(mel.reshape(-1)).sum() > 0:
+        raise ValueError("Mel spectrogram contains NaN")
+
+    return audio.mel_chunks(mel, FPS, MEL_STEP_SIZE)
+
+def load_mel_chunks(audio_bytes):
+    # Decoded in memory; no temp file round-trip through librosa
+    wav = audio.load_wav_bytes(audio_bytes, 16000)
+    return mel_chunks_from_wav(wav)
+
+def frame_timestamp_ms(index):
+    """Presentation time of the frame generated from mel chunk ``index``."""
+    return int(round(index * 1000 / FPS))
+
+def encode_stream_frames(frames, fmt):
+    if fmt == "jpeg":
+        return [cv2.imencode(".jpg", f, [cv2.IMWRITE_JPEG_QUALITY, STREAM_JPEG_QUALITY])[1].tobytes() for f in frames]
+    return [f.tobytes() for f in frames]
+
+def next_stream_batch(batches, fmt):
+    """Run the next inference batch and encode its frames for the WebSocket stream."""
+    batch = next(batches, None)
+    if batch is None:
+        return None
+    start, frames = batch
+    return start, encode_stream_frames(frames, fmt)
+
+class AudioStreamSession:
+    """Renders frames for audio that arrives as PCM chunks over the WebSocket.
+
+    Each mel window is inferred as soon as the audio covering it has arrived
+    (about 200 ms for the first frame), instead of waiting for the whole clip.
+    """
+
+    def __init__(self, model, avatar, fmt):
+        self.model = model
+        self.avatar = avatar
+        self.fmt = fmt
+        self.mel_stream = audio.StreamingMel()
+        self.mel = np.empty((80, 0))
+        self.next_chunk = 0
+        self._pending = b""
+
+    def feed(self, pcm_bytes):
+        """Add mono 16 kHz s16le PCM (None ends the stream).
+
+        Returns ``(start, payloads)`` for the frames that became renderable.
+        """
+        if pcm_bytes is None:
+            new_mel = self.mel_stream.flush()
+        else:
+            # A message may end in the middle of a sample; keep the odd byte for the next one
+            data = self._pending + pcm_bytes
+            usable = len(data) - len(data) % 2
+            self._pending = data[usable:]
+            wav = np.frombuffer(data[:usable], dtype="<i2").astype(np.float32) / 32768.0
+            new_mel = self.mel_stream.push(wav)
+
+        if np.isnan(new_mel).any():
+            raise ValueError("Mel spectrogram contains NaN")
+        self.mel = np.concatenate((self.mel, new_mel), axis=1)
 
-# Load model on startup
-load_model()
+        start = self.next_chunk
+        chunks = audio.mel_chunks(self.mel, FPS, MEL_STEP_SIZE, first=start)
+        self.next_chunk += len(chunks)
+        if len(chunks) == 0:
+            return start, []
+        return start, encode_stream_frames(run_batched_inference(self.model, chunks, self.avatar), self.fmt)
+
+async def send_stream_frames(websocket, start, payloads):
+    for offset, payload in enumerate(payloads):
+        index = start + offset
+        await websocket.send_bytes(struct.pack("<II", index, frame_timestamp_ms(index)) + payload)
+
+async def stream_pcm_audio(websocket, model, avatar, fmt):
+    """Streamed-audio mode of /wav2lip/stream: binary PCM messages in, frames out."""
+    session = AudioStreamSession(model, avatar, fmt)
+    await websocket.send_json({
+        "type": "start",
+        "frames": None,  # unknown until the audio ends
+        "fps": FPS,
+        "width": 96,
+        "height": 96,
+        "format": fmt
+    })
+
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("bytes") is not None:
+            start, payloads = await run_in_threadpool(session.feed, message["bytes"])
+            await send_stream_frames(websocket, start, payloads)
+        elif message.get("text") is not None:
+            # Any text message ({"type": "end"}) closes the audio stream
+            start, payloads = await run_in_threadpool(session.feed, None)
+            await send_stream_frames(websocket, start, payloads)
+            break
+
+    return session.next_chunk
+
+@app.on_event("startup")
+def load_on_startup():
+    # In the background so /health can answer (and report "warming") while the models compile
+    threading.Thread(target=start_service, daemon=True).start()
 
 @app.get("/health")
 async def health():
     return {
         "status": "ok",
-        "service_ready": compiled_model is not None,
-        "model_loaded": compiled_model is not None
+        "state": service_state,
+        "service_ready": service_state == "ready",
+        "model_loaded": bool(models),
+        "startup_times_s": startup_times,
+        "cache_dir": CACHE_DIR or None,
+        "models": {quality: model.describe() for quality, model in models.items()},
+        "avatar_cache": avatar_cache.stats()
     }
 
-@app.post("/wav2lip/generate")
-async def generate(
-    avatar_image: str = Form(...),
-    audio_param: str = Form(..., alias='audio'),
-    quality: str = Form("base")
+@app.post("/wav2lip/avatars")
+def register_avatar(
+    avatar_image: Optional[str] = Form(None),
+    avatar_file: Optional[UploadFile] = File(None)
 ):
-    if not compiled_model:
-        raise HTTPException(status_code=500, detail="Model not loaded")
+    """Preprocess an avatar once and return the ID to send instead of the image."""
+    image_bytes = read_input(avatar_file, avatar_image)
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="avatar_image or avatar_file is required")
+    try:
+        avatar_id, _ = avatar_cache.get_or_create(image_bytes, prepare_avatar)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"avatar_id": avatar_id}
 
-    temp_audio_path = None
-    temp_video_path = None
+@app.post("/wav2lip/generate")
+def generate(
+    request: Request,
+    avatar_image: Optional[str] = Form(None),
+    audio_param: Optional[str] = Form(None, alias='audio'),
+    quality: str = Form("base"),  # any quality in the manifest, e.g. "gan" or "base_int8"
+    avatar_id: Optional[str] = Form(None),
+    avatar_file: Optional[UploadFile] = File(None),
+    audio_file: Optional[UploadFile] = File(None),
+    response_format: Optional[str] = Form(None)  # "json" (Base64) or "binary" (video/mp4)
+):
+    model = select_model(quality)
 
     try:
-        # 1. Read Image (Base64)
-        # Remove header if present
-        if "base64," in avatar_image:
-            avatar_image = avatar_image.split("base64,")[1]
-            
-        image_bytes = base64.b64decode(avatar_image)
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if frame is None:
-            raise HTTPException(status_code=400, detail="Invalid image")
-
-        # Resize to 96x96 for inference
-        face_input = cv2.resize(frame, (96, 96))
-        
-        # Prepare face input (1, 6, 96, 96)
-        # Mask lower half
-        mask = np.zeros_like(face_input)
-        mask[48:, :, :] = 1 
-        masked_face = face_input * (1 - mask)
-        
-        # Concatenate: (Channel, H, W)
-        ref_img = face_input.transpose(2, 0, 1)
-        masked_img = masked_face.transpose(2, 0, 1)
-        
-        # Concatenate along channel dimension: (6, 96, 96)
-        face_seq = np.concatenate((masked_img, ref_img), axis=0)
-        face_seq = face_seq[np.newaxis, :, :, :] # (1, 6, 96, 96)
-        face_seq = face_seq.astype(np.float32) / 255.0
-        
-        # 2. Process Audio (Base64)
-        audio_data = audio_param
-        if "base64," in audio_data:
-            audio_data = audio_data.split("base64,")[1]
-            
-        audio_bytes = base64.b64decode(audio_data)
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_audio:
-            temp_audio.write(audio_bytes)
-            temp_audio_path = temp_audio.name
-            
-        wav = audio.load_wav(temp_audio_path, 16000)
-        mel = audio.melspectrogram(wav)
+        # 1. Resolve avatar: registered ID, multipart file or Base64 image (cached by content hash)
+        avatar = resolve_avatar(read_input(avatar_file, avatar_image), avatar_id)
         
-        if np.isnan(mel.reshape(-1)).sum() > 0:
-            raise HTTPException(status_code=400, detail="Mel spectrogram contains NaN")
-
-        # Chunking logic
-        mel_chunks = []
-        fps = 25
-        mel_idx_multiplier = 80. / fps
-        i = 0
-        while 1:
-            start_idx = int(i * mel_idx_multiplier)
-            if start_idx + 16 > mel.shape[1]:
-                break
-            mel_chunks.append(mel[:, start_idx : start_idx + 16])
-            i += 1
+        # 2. Process Audio (multipart file or Base64)
+        audio_bytes = read_input(audio_file, audio_param)
+        if not audio_bytes:
+            raise HTTPException(status_code=400, detail="audio or audio_file is required")
+        mel_chunks = load_mel_chunks(audio_bytes)
+        fps = FPS
 
         print(f"Generated {len(mel_chunks)} frames.")
         
-        # 3. Inference Loop
-        result_frames = []
-        
-        # Batch processing? OpenVINO supports batching but our model is exported with B=1.
-        # We loop.
-        
-        for m in mel_chunks:
-            # Prepare audio input: (1, 1, 80, 16)
-            m = m[np.newaxis, np.newaxis, :, :]
-            
-            # Run Inference
-            # Inputs: [audio, face]
-            # Note: face_seq is constant for all frames (static image)
-            
-            # OpenVINO inference
-            request = compiled_model.create_infer_request()
-            request.infer({
-                input_layer_audio: m,
-                input_layer_face: face_seq
-            })
-            res = request.get_output_tensor(0).data
-            
-            # res shape: (1, 3, 96, 96)
-            pred = res[0].transpose(1, 2, 0) * 255.0
-            pred = pred.astype(np.uint8)
-            result_frames.append(pred)
+        # 3. Inference (batched over mel chunks)
+        result_frames = infer_frames(model, mel_chunks, avatar) if len(mel_chunks) else []
             
         # 4. Generate Video
-        if not result_frames:
+        if len(result_frames) == 0:
              raise HTTPException(status_code=400, detail="No frames generated")
 
-        with tempfile.NamedTemporaryFile(suffix=".avi", delete=False) as temp_video:
-            temp_video_path = temp_video.name
-            
-        # OpenCV writes AVI, we'll convert to MP4 with ffmpeg later
-        out = cv2.VideoWriter(
-            temp_video_path,
-            cv2.VideoWriter_fourcc(*'DIVX'), 
-            fps, 
-            (96, 96)
-        )
-        
-        for f in result_frames:
-            out.write(f)
-        out.release()
-        
-        # Combine with audio using ffmpeg (optional but good for sync)
-        # But we return base64 video.
-        # The browser plays video. If we just return video frames, audio is separate?
-        # The current implementation returns video WITHOUT audio?
-        # Let's check wav2lipService.ts.
-        # It sets `videoRef.current.src = videoUrl`.
-        # If the video has no audio, it won't play audio.
-        # But the audio is played by the browser separately?
-        # No, usually we want the video to have audio.
-        # The existing `wav2lip_service/main.py` uses ffmpeg to merge audio.
-        
-        # We should merge audio.
-        # We need ffmpeg.
-        final_video_path = temp_video_path.replace(".avi", "_final.mp4")
-        
-        # Convert to MP4 with H.264 (browser-compatible) and merge audio
-        subprocess_cmd = [
-            "ffmpeg", "-y",
-            "-i", temp_video_path,
-            "-i", temp_audio_path,
-            "-c:v", "libx264",  # H.264 codec for browser compatibility
-            "-preset", "ultrafast",  # Fast encoding
-            "-pix_fmt", "yuv420p",  # Compatible pixel format
-            "-c:a", "aac",
-            "-b:a", "128k",  # Audio bitrate
-            "-strict", "experimental",
-            final_video_path
-        ]
-        import subprocess
-        subprocess.check_call(subprocess_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        # Read final video
-        with open(final_video_path, "rb") as f:
-            video_base64 = base64.b64encode(f.read()).decode("utf-8")
-            
-        # Cleanup
-        if os.path.exists(final_video_path):
-            os.remove(final_video_path)
+        # Single ffmpeg pass: raw frames over stdin, audio merged in, fragmented MP4 from stdout
+        with FFmpegEncoder(96, 96, fps, audio_bytes=audio_bytes) as encoder:
+            encoder.write(result_frames)
+            video_bytes = encoder.finish()
+
+        duration_ms = int((len(result_frames) / fps) * 1000)
+        if wants_binary_response(request, response_format):
+            return Response(content=video_bytes, media_type="video/mp4",
+                            headers={"X-Duration-Ms": str(duration_ms)})
+
+        video_base64 = base64.b64encode(video_bytes).decode("utf-8")
             
         return {
             "video": video_base64,
-            "duration_ms": int((len(result_frames) / fps) * 1000)
+            "duration_ms": duration_ms
         }
 
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-        
-    finally:
-        if temp_audio_path and os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
-        if temp_video_path and os.path.exists(temp_video_path):
-            os.remove(temp_video_path)
+
+@app.websocket("/wav2lip/stream")
+async def stream(websocket: WebSocket):
+    """
+    Stream lip-sync frames while the rest of the utterance is still rendering.
+
+    The client sends one JSON message with the /wav2lip/generate fields
+    (avatar_image or avatar_id, audio, quality) and an optional "format"
+    ("jpeg" or "raw"). The server replies with a "start" JSON message, one
+    binary message per frame in chunk order and a final "end" JSON message.
+    Each binary message is an 8-byte little-endian header (uint32 mel chunk
+    index, uint32 timestamp in ms) followed by the JPEG bytes or the raw
+    96x96x3 BGR pixels.
+
+    With "audio_format": "pcm_s16le" (and no "audio") the audio is streamed
+    too: the client sends mono 16 kHz little-endian int16 PCM as binary
+    messages and {"type": "end"} when done, and frames are rendered as soon
+    as the audio for each mel window has arrived.
+    """
+    await websocket.accept()
+
+    try:
+        params = await websocket.receive_json()
+        fmt = params.get("format", "jpeg")
+        if fmt not in STREAM_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+        model = select_model(params.get("quality", "base"))
+        avatar_image = params.get("avatar_image")
+        image_bytes = decode_base64_field(avatar_image) if avatar_image else None
+        avatar = await run_in_threadpool(resolve_avatar, image_bytes, params.get("avatar_id"))
+
+        if params.get("audio_format") == "pcm_s16le":
+            num_frames = await stream_pcm_audio(websocket, model, avatar, fmt)
+        else:
+            if not params.get("audio"):
+                raise HTTPException(status_code=400, detail="audio is required")
+            mel_chunks = await run_in_threadpool(load_mel_chunks, decode_base64_field(params["audio"]))
+            if len(mel_chunks) == 0:
+                raise HTTPException(status_code=400, detail="No frames generated")
+
+            await websocket.send_json({
+                "type": "start",
+                "frames": len(mel_chunks),
+                "fps": FPS,
+                "width": 96,
+                "height": 96,
+                "format": fmt
+            })
+
+            batches = iter_batched_inference(model, mel_chunks, avatar)
+            while True:
+                batch = await run_in_threadpool(next_stream_batch, batches, fmt)
+                if batch is None:
+                    break
+                await send_stream_frames(websocket, *batch)
+            num_frames = len(mel_chunks)
+
+        await websocket.send_json({
+            "type": "end",
+            "frames": num_frames,
+            "duration_ms": int((num_frames / FPS) * 1000)
+        })
+    except WebSocketDisconnect:
+        return
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+    except ValueError as e:
+        await websocket.send_json({"type": "error", "status": 400, "detail": str(e)})
+    except Exception as e:
+        print(f"Stream error: {e}")
+        await websocket.send_json({"type": "error", "status": 500, "detail": str(e)})
+
+    await websocket.close()
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8301) # Port 8301 for new service
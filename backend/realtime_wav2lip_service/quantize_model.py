@@ -0,0 +1,258 @@
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+import nncf
+import openvino.runtime as ov
+
+import audio
+from wav2lip_models import face_sequence
+
+# Post-training INT8 quantization of the IRs written by convert_model.py.
+# Calibrates on a few local avatar images + audio clips, saves <ir>_int8.xml
+# (e.g. wav2lip_openvino_int8.xml), adds it to the manifest as a new quality
+# and writes a latency/quality report against the same IR run in FP32.
+
+wav2lip_service_path = Path(__file__).parent.parent / "wav2lip_service"
+
+FPS = 25
+MEL_STEP_SIZE = 16
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.ogg', '.flac')
+# Reference precision the INT8 graphs are compared against
+FP32_CONFIG = {"INFERENCE_PRECISION_HINT": "f32"}
+
+parser = argparse.ArgumentParser(description='Quantize the Wav2Lip OpenVINO IRs to INT8 with NNCF')
+parser.add_argument('--samples_dir', type=str, required=True,
+                    help='Avatar images and audio clips used for calibration and the report; '
+                         'every image is paired with every clip')
+parser.add_argument('--manifest', type=str, default='wav2lip_manifest.json',
+                    help='Manifest written by convert_model.py')
+parser.add_argument('--source', type=str, default='base',
+                    help='Quality in the manifest to quantize')
+parser.add_argument('--name', type=str, default=None,
+                    help='Quality the INT8 model is served as (default: <source>_int8)')
+parser.add_argument('--subset_size', type=int, default=300,
+                    help='Number of single-frame calibration samples')
+parser.add_argument('--batch_size', type=int, default=32,
+                    help='Batch size for the latency measurement')
+parser.add_argument('--iterations', type=int, default=20,
+                    help='Timed inference calls per model for the latency measurement')
+parser.add_argument('--syncnet_checkpoint', type=str,
+                    default=str(wav2lip_service_path / "checkpoints" / "lipsync_expert.pth"),
+                    help='SyncNet expert checkpoint for the lip-sync score (skipped if missing)')
+
+
+def load_samples(samples_dir):
+    """(face_seq, mel_chunks) for every avatar image in ``samples_dir`` paired with every audio clip."""
+    files = sorted(Path(samples_dir).iterdir())
+    faces = []
+    for path in files:
+        if path.suffix.lower() in IMAGE_EXTENSIONS:
+            frame = cv2.imread(str(path))
+            if frame is None:
+                print(f"Could not read image {path}, skipping")
+                continue
+            faces.append(face_sequence(frame))
+
+    clips = []
+    for path in files:
+        if path.suffix.lower() in AUDIO_EXTENSIONS:
+            mel = audio.melspectrogram(audio.load_wav(str(path), 16000))
+            chunks = audio.mel_chunks(mel, FPS, MEL_STEP_SIZE)
+            if len(chunks):
+                clips.append(chunks)
+
+    if not faces or not clips:
+        print(f"Need at least one image and one audio clip in {samples_dir}")
+        sys.exit(1)
+    return [(face_seq, mel_chunks) for face_seq in faces for mel_chunks in clips]
+
+
+def calibration_items(samples, subset_size):
+    """Up to ``subset_size`` single-frame ``(mel, face_seq)`` items spread evenly over every sample."""
+    per_sample = -(-subset_size // len(samples))
+    items = []
+    for face_seq, mel_chunks in samples:
+        for i in np.linspace(0, len(mel_chunks) - 1, min(per_sample, len(mel_chunks))).astype(int):
+            items.append((mel_chunks[i : i + 1], face_seq))
+    return items[:subset_size]
+
+
+def input_builder(graph, encoder):
+    """Return ``build(mel_batch, face_seq) -> inputs`` for the "full" or "decoder" graph.
+
+    The decoder gets the avatar's features from the (FP32) face encoder,
+    computed once per avatar like in the service.
+    """
+    if graph == "full":
+        return lambda mel, face_seq: {
+            "audio_sequences": mel,
+            "face_sequences": np.repeat(face_seq, len(mel), axis=0)
+        }
+
+    features = {}
+    def build(mel, face_seq):
+        key = id(face_seq)
+        if key not in features:
+            result = encoder({0: face_seq})
+            features[key] = {output.get_any_name(): result[output] for output in encoder.outputs}
+        return {"audio_sequences": mel, **features[key]}
+    return build
+
+
+def run(compiled_model, build, mel_chunks, face_seq, batch_size):
+    """(N, 3, 96, 96) outputs in [0, 1] for all mel chunks of one sample."""
+    request = compiled_model.create_infer_request()
+    outputs = []
+    for start in range(0, len(mel_chunks), batch_size):
+        request.infer(build(mel_chunks[start : start + batch_size], face_seq))
+        outputs.append(request.get_output_tensor(0).data.copy())
+    return np.concatenate(outputs)
+
+
+def measure_latency(compiled_model, build, sample, batch_size, iterations):
+    face_seq, mel_chunks = sample
+    inputs = build(mel_chunks[np.arange(batch_size) % len(mel_chunks)], face_seq)
+    request = compiled_model.create_infer_request()
+    # The first call pays for memory allocation; keep it out of the numbers
+    request.infer(inputs)
+
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        request.infer(inputs)
+        times.append(time.perf_counter() - start)
+    batch_ms = float(np.median(times)) * 1000
+    return {"batch_size": batch_size, "batch_ms": round(batch_ms, 2), "frame_ms": round(batch_ms / batch_size, 3)}
+
+
+def load_syncnet(checkpoint_path):
+    if not Path(checkpoint_path).exists():
+        print(f"SyncNet checkpoint not found at {checkpoint_path}, reporting L1 only")
+        return None
+
+    import torch
+    sys.path.append(str(wav2lip_service_path))
+    from models import SyncNet_color
+
+    syncnet = SyncNet_color()
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+    syncnet.load_state_dict({k.replace('module.', ''): v for k, v in checkpoint["state_dict"].items()})
+    return syncnet.eval()
+
+
+def sync_score(syncnet, frames, mel_chunks):
+    """Mean SyncNet cosine similarity between 5-frame windows of ``frames`` and their mel windows."""
+    import torch
+
+    n = len(frames) - 4
+    if n <= 0:
+        return None
+    # SyncNet sees the lower half of 5 consecutive faces stacked on the channel axis
+    lower = frames[:, :, frames.shape[2] // 2:]
+    windows = np.concatenate([lower[i : i + n] for i in range(5)], axis=1)
+    with torch.no_grad():
+        audio_embedding, face_embedding = syncnet(torch.from_numpy(mel_chunks[:n]).float(),
+                                                  torch.from_numpy(windows).float())
+    return float((audio_embedding * face_embedding).sum(dim=1).mean())
+
+
+def compare_quality(reference, candidate, build, samples, syncnet, batch_size):
+    l1, sync_fp32, sync_int8 = [], [], []
+    for face_seq, mel_chunks in samples:
+        expected = run(reference, build, mel_chunks, face_seq, batch_size)
+        actual = run(candidate, build, mel_chunks, face_seq, batch_size)
+        # Mean absolute difference in 8-bit pixel values
+        l1.append(float(np.abs(expected - actual).mean()) * 255)
+        if syncnet is not None:
+            sync_fp32.append(sync_score(syncnet, expected, mel_chunks))
+            sync_int8.append(sync_score(syncnet, actual, mel_chunks))
+
+    quality = {"l1_vs_fp32": round(float(np.mean(l1)), 3)}
+    sync_fp32 = [s for s in sync_fp32 if s is not None]
+    sync_int8 = [s for s in sync_int8 if s is not None]
+    if sync_fp32:
+        quality["syncnet_fp32"] = round(float(np.mean(sync_fp32)), 4)
+        quality["syncnet_int8"] = round(float(np.mean(sync_int8)), 4)
+    return quality
+
+
+def quantize(args):
+    manifest_path = Path(args.manifest)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    source = manifest["models"].get(args.source)
+    if source is None:
+        print(f"Quality '{args.source}' not in {manifest_path} ({', '.join(manifest['models'])})")
+        sys.exit(1)
+    name = args.name or f"{args.source}_int8"
+    model_dir = manifest_path.parent
+
+    core = ov.Core()
+    samples = load_samples(args.samples_dir)
+    calibration = calibration_items(samples, args.subset_size)
+    syncnet = load_syncnet(args.syncnet_checkpoint)
+
+    # Split graphs: only the decoder runs per batch, the face encoder (once per avatar) is kept as is
+    encoder = None
+    if "face_encoder" in source and "decoder" in source:
+        encoder = core.compile_model(str(model_dir / source["face_encoder"]["xml"]), "CPU", FP32_CONFIG)
+
+    entry = {"checkpoint": source.get("checkpoint"), "source": args.source}
+    report = {"source": args.source, "samples": len(samples), "calibration_items": len(calibration), "graphs": {}}
+    for graph in ("full", "decoder"):
+        if graph not in source or (graph == "decoder" and encoder is None):
+            continue
+        build = input_builder(graph, encoder)
+        xml_path = model_dir / source[graph]["xml"]
+        model = core.read_model(str(xml_path))
+        reference = core.compile_model(model, "CPU", FP32_CONFIG)
+
+        print(f"Quantizing {xml_path} on {len(calibration)} calibration samples...")
+        quantized = nncf.quantize(
+            model,
+            nncf.Dataset(calibration, lambda item: build(*item)),
+            preset=nncf.QuantizationPreset.MIXED,
+            subset_size=len(calibration)
+        )
+        int8_xml = f"{xml_path.stem}_int8.xml"
+        ov.serialize(quantized, str(model_dir / int8_xml))
+        print(f"Model saved to {model_dir / int8_xml}")
+        entry[graph] = dict(source[graph], xml=int8_xml, precision="int8")
+
+        candidate = core.compile_model(quantized, "CPU")
+        print(f"Measuring latency and quality of {int8_xml} against FP32...")
+        report["graphs"][graph] = {
+            "xml": int8_xml,
+            "latency": {
+                "fp32": measure_latency(reference, build, samples[0], args.batch_size, args.iterations),
+                "int8": measure_latency(candidate, build, samples[0], args.batch_size, args.iterations),
+            },
+            "quality": compare_quality(reference, candidate, build, samples, syncnet, args.batch_size),
+        }
+
+    if encoder is not None:
+        entry["face_encoder"] = source["face_encoder"]
+
+    report_name = f"{Path(entry['full']['xml']).stem}_report.json"
+    with open(model_dir / report_name, "w") as f:
+        json.dump(report, f, indent=2)
+    entry["report"] = report_name
+
+    manifest["models"][name] = entry
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    for graph, result in report["graphs"].items():
+        latency = result["latency"]
+        print(f"{graph}: {latency['fp32']['frame_ms']} -> {latency['int8']['frame_ms']} ms/frame, "
+              f"{json.dumps(result['quality'])}")
+    print(f"Report written to {model_dir / report_name}; serving as quality '{name}'")
+
+if __name__ == "__main__":
+    quantize(parser.parse_args())
@@ -0,0 +1,242 @@
+"""
+OpenVINO Wav2Lip models described by the converter manifest.
+
+convert_model.py writes wav2lip_manifest.json next to the IRs it exports:
+for every quality the full graph and, with --split, a face encoder and a
+decoder, each with its input/output shapes (-1 marks a dynamic dimension).
+The service loads whatever the manifest lists, so a new export is picked up
+without editing the service or the IRs.
+"""
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import openvino.runtime as ov
+
+DYNAMIC = -1
+
+
+def load_manifest(path):
+    """Return quality -> manifest entry, with the IR paths resolved against the manifest's directory."""
+    path = Path(path)
+    with open(path) as f:
+        manifest = json.load(f)
+
+    entries = {}
+    for quality, entry in manifest["models"].items():
+        entry = dict(entry)
+        for graph in ("full", "face_encoder", "decoder"):
+            if graph in entry:
+                entry[graph] = dict(entry[graph], xml=str(path.parent / entry[graph]["xml"]))
+        entries[quality] = entry
+    return entries
+
+
+def face_sequence(frame):
+    """Build the (1, 6, 96, 96) float32 masked+reference face input from a BGR image."""
+    # Resize to 96x96 for inference
+    face_input = cv2.resize(frame, (96, 96))
+
+    # Mask lower half
+    mask = np.zeros_like(face_input)
+    mask[48:, :, :] = 1
+    masked_face = face_input * (1 - mask)
+
+    # Concatenate: (Channel, H, W)
+    ref_img = face_input.transpose(2, 0, 1)
+    masked_img = masked_face.transpose(2, 0, 1)
+
+    # Concatenate along channel dimension: (6, 96, 96)
+    face_seq = np.concatenate((masked_img, ref_img), axis=0)
+    face_seq = face_seq[np.newaxis, :, :, :] # (1, 6, 96, 96)
+    return face_seq.astype(np.float32) / 255.0
+
+
+def legacy_entry(xml_path):
+    """Manifest entry for a full-graph IR exported before the manifest existed (shapes unknown)."""
+    return {"full": {"xml": str(xml_path)}}
+
+
+def reshape_dynamic_batch(model):
+    """Make the batch dimension of every input dynamic so chunks can be stacked."""
+    new_shapes = {}
+    for model_input in model.inputs:
+        shape = model_input.get_partial_shape()
+        shape[0] = ov.Dimension()
+        new_shapes[model_input] = shape
+    model.reshape(new_shapes)
+
+
+def has_dynamic_batch(graph):
+    """True if the manifest records a dynamic batch dimension on every input of ``graph``."""
+    inputs = graph.get("inputs")
+    return bool(inputs) and all(shape[0] == DYNAMIC for shape in inputs.values())
+
+
+class Wav2LipModel:
+    """One quality of the generator, compiled, with its pool of infer requests.
+
+    With split graphs the face encoder runs once per avatar and only the
+    decoder runs per batch, with the avatar's features broadcast over the mel
+    batch; otherwise the full graph gets the face input repeated per chunk.
+    """
+
+    def __init__(self, quality, entry):
+        self.quality = quality
+        self.entry = entry
+        self.split = "face_encoder" in entry and "decoder" in entry
+        self.max_batch_size = 1
+        self.num_infer_requests = 0
+        self.compiled_model = None
+        self.input_audio = None
+        self.input_face = None
+        self.input_feats = []
+        self.output = None
+        self.infer_requests = queue.Queue()
+        self.async_queue = None
+        self.async_submit_lock = threading.Lock()
+        self.face_encoder = None
+        self._encoder_request = None
+        self._encoder_lock = threading.Lock()
+        self.compile_time = None
+        self.warmup_time = None
+
+    def read_graph(self, core, name, batch_size):
+        """Read one graph of the entry and make sure its batch dimension is dynamic."""
+        graph = self.entry[name]
+        model = core.read_model(model=graph["xml"])
+        if has_dynamic_batch(graph):
+            return model, batch_size
+
+        # IRs exported with B=1 (or without a manifest): open up the batch dimension for batching
+        try:
+            reshape_dynamic_batch(model)
+        except Exception as e:
+            print(f"Could not reshape {graph['xml']} to dynamic batch: {e}. Falling back to batch size 1.")
+            return model, 1
+        return model, batch_size
+
+    def load(self, core, device, batch_size, num_infer_requests, async_jobs=None, async_callback=None, config=None):
+        """Compile the graphs on ``device`` with the properties in ``config``.
+
+        Creates ``num_infer_requests`` reusable infer requests (0 uses the
+        compiled model's OPTIMAL_NUMBER_OF_INFER_REQUESTS, which follows the
+        performance hint and number of streams). With ``async_jobs`` (0 lets
+        OpenVINO pick) an AsyncInferQueue calling ``async_callback`` is
+        created as well.
+        """
+        config = config or {}
+        start = time.perf_counter()
+        model, self.max_batch_size = self.read_graph(core, "decoder" if self.split else "full", batch_size)
+        self.compiled_model = core.compile_model(model=model, device_name=device, config=config)
+
+        if self.split:
+            encoder, _ = self.read_graph(core, "face_encoder", 1)
+            # Runs once per new avatar, one call at a time: always latency-oriented
+            encoder_config = {key: value for key, value in config.items() if key != "NUM_STREAMS"}
+            encoder_config["PERFORMANCE_HINT"] = "LATENCY"
+            self.face_encoder = core.compile_model(model=encoder, device_name=device, config=encoder_config)
+            self._encoder_request = self.face_encoder.create_infer_request()
+            self.input_audio = self.compiled_model.input("audio_sequences")
+            self.input_feats = [self.compiled_model.input(output.get_any_name())
+                                for output in self.face_encoder.outputs]
+            self.output = self.compiled_model.output("outputs")
+        else:
+            # Names might vary for IRs exported by hand; fall back to the input/output order
+            try:
+                self.input_audio = self.compiled_model.input("audio_sequences")
+                self.input_face = self.compiled_model.input("face_sequences")
+                self.output = self.compiled_model.output("outputs")
+            except Exception as e:
+                print(f"Error getting layers by name: {e}. Trying by index.")
+                self.input_audio = self.compiled_model.input(0)
+                self.input_face = self.compiled_model.input(1)
+                self.output = self.compiled_model.output(0)
+
+        # Infer requests are expensive to create, so keep a fixed pool and reuse them
+        if num_infer_requests <= 0:
+            num_infer_requests = self.compiled_model.get_property("OPTIMAL_NUMBER_OF_INFER_REQUESTS")
+        self.num_infer_requests = num_infer_requests
+        for _ in range(num_infer_requests):
+            self.infer_requests.put(self.compiled_model.create_infer_request())
+
+        if async_jobs is not None:
+            self.async_queue = ov.AsyncInferQueue(self.compiled_model, async_jobs)
+            self.async_queue.set_callback(async_callback)
+        self.compile_time = time.perf_counter() - start
+
+    def warm_up(self, batch_sizes):
+        """Run every infer request once per batch size (capped at ``max_batch_size``).
+
+        With a dynamic batch the CPU plugin prepares kernels and buffers the
+        first time it sees a shape; doing that here keeps it out of the first
+        real requests. Must run before the model serves requests.
+        """
+        start = time.perf_counter()
+        avatar = SimpleNamespace(face_seq=np.zeros((1, 6, 96, 96), dtype=np.float32), face_feats={})
+        requests = list(self.infer_requests.queue)
+        if self.async_queue is not None:
+            requests += [self.async_queue[i] for i in range(len(self.async_queue))]
+
+        for batch_size in sorted({max(1, min(b, self.max_batch_size)) for b in batch_sizes}):
+            inputs = self.batch_inputs(np.zeros((batch_size, 1, 80, 16), dtype=np.float32),
+                                       self.face_inputs(avatar, batch_size))
+            for request in requests:
+                request.infer(inputs)
+        self.warmup_time = time.perf_counter() - start
+
+    @contextmanager
+    def acquire_infer_request(self):
+        """Borrow an infer request from the pool, blocking until one is free."""
+        request = self.infer_requests.get()
+        try:
+            yield request
+        finally:
+            self.infer_requests.put(request)
+
+    def face_features(self, face_seq):
+        """Run the face encoder on a (1, 6, 96, 96) face input and return its seven features."""
+        with self._encoder_lock:
+            self._encoder_request.infer({0: face_seq})
+            return [self._encoder_request.get_tensor(output).data.copy() for output in self.face_encoder.outputs]
+
+    def face_inputs(self, avatar, batch_size):
+        """Face inputs that stay the same for every batch of ``avatar``.
+
+        Split graphs use the avatar's features, encoded on first use and kept
+        in ``avatar.face_feats``; the full graph gets the face input repeated
+        ``batch_size`` times.
+        """
+        if not self.split:
+            # face_seq is constant for all frames (static image); leading slices stay contiguous
+            return {self.input_face: np.repeat(avatar.face_seq, batch_size, axis=0)}
+
+        feats = avatar.face_feats.get(self.quality)
+        if feats is None:
+            feats = avatar.face_feats[self.quality] = self.face_features(avatar.face_seq)
+        return dict(zip(self.input_feats, feats))
+
+    def batch_inputs(self, mel_batch, face_inputs):
+        """Inputs of one infer call for ``mel_batch`` given the avatar's ``face_inputs``."""
+        inputs = {self.input_audio: mel_batch}
+        for port, value in face_inputs.items():
+            # Features are broadcast over the batch inside the decoder; the repeated face is cut to size
+            inputs[port] = value if self.split else value[:len(mel_batch)]
+        return inputs
+
+    def describe(self):
+        return {
+            "split": self.split,
+            "max_batch_size": self.max_batch_size,
+            "infer_requests": self.num_infer_requests,
+            "streams": None if self.compiled_model is None else str(self.compiled_model.get_property("NUM_STREAMS")),
+            "precision": self.entry["decoder" if self.split else "full"].get("precision"),
+            "compile_s": None if self.compile_time is None else round(self.compile_time, 3),
+            "warmup_s": None if self.warmup_time is None else round(self.warmup_time, 3),
+        }
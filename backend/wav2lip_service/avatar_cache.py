@@ -0,0 +1,71 @@
+"""
+Content-addressed LRU cache for preprocessed avatars.
+
+Avatars are keyed by the SHA-256 of their encoded image bytes, so the same
+picture always maps to the same ID no matter which client uploads it. The
+cached value is whatever the service needs to skip decoding, face detection
+and tensor preparation on the next request.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class AvatarCache:
+    def __init__(self, max_entries=32):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(image_bytes):
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def get(self, key):
+        """Return the cached value for ``key`` (marking it most recently used) or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_create(self, image_bytes, build):
+        """Return ``(key, value)``, calling ``build(image_bytes)`` only on a cache miss."""
+        key = self.key_for(image_bytes)
+        value = self.get(key)
+        if value is None:
+            value = build(image_bytes)
+            self.put(key, value)
+        return key, value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,113 @@
+"""
+Memory-aware batch sizing for face detection and Wav2Lip inference.
+
+Batch sizes are derived from a per-sample memory estimate and a RAM budget
+instead of fixed numbers, and an out-of-memory failure only shrinks and
+retries the batch that failed; batches already done are kept.
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Used when neither a budget is configured nor the free memory can be read
+DEFAULT_BUDGET_BYTES = 4 * 2**30
+
+# S3FD is VGG16 at full input resolution: the two 64-channel float32 maps of
+# the first block, the 128-channel map of the second and the input are alive
+# at the same time, i.e. about (2 * 64 + 128 + 3) * 4 bytes per pixel
+S3FD_BYTES_PER_PIXEL = (2 * 64 + 128 + 3) * 4
+
+# Wav2Lip activations and inputs for one 96x96 face + (80, 16) mel window,
+# rounded up from the sum of the encoder/decoder feature maps
+WAV2LIP_SAMPLE_BYTES = 16 * 2**20
+
+
+def meminfo_available():
+    """MemAvailable from /proc/meminfo in bytes (Linux), or None."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    # "MemAvailable:   5767168 kB"
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def available_memory(device='cpu'):
+    """Memory in bytes that ``device`` can still hand out, or None when it cannot be determined."""
+    if 'cuda' in device:
+        import torch
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    # MemAvailable counts reclaimable page cache; SC_AVPHYS_PAGES (MemFree) does not and
+    # would shrink batches on any host with a warm cache
+    available = meminfo_available()
+    if available is not None:
+        return available
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        # sysconf is not available on Windows
+        return None
+
+
+def resolve_budget(budget_mb=0, device='cpu'):
+    """Budget in bytes: ``budget_mb`` if set, else half of the available memory on ``device``."""
+    if budget_mb > 0:
+        return int(budget_mb * 2**20)
+    free = available_memory(device)
+    return free // 2 if free else DEFAULT_BUDGET_BYTES
+
+
+def s3fd_sample_bytes(height, width):
+    return height * width * S3FD_BYTES_PER_PIXEL
+
+
+def wav2lip_sample_bytes(frame_h, frame_w):
+    # Each sample also keeps its full BGR frame around until the prediction is pasted back
+    return WAV2LIP_SAMPLE_BYTES + frame_h * frame_w * 3
+
+
+def plan_batch_size(name, sample_bytes, max_batch_size, budget_bytes):
+    """Largest batch size up to ``max_batch_size`` whose estimate fits ``budget_bytes``."""
+    batch_size = int(max(1, min(max_batch_size, budget_bytes // max(1, sample_bytes))))
+    logger.info(f"{name}: batch size {batch_size} (~{sample_bytes / 2**20:.1f} MiB/sample, "
+                f"budget {budget_bytes / 2**20:.0f} MiB)")
+    return batch_size
+
+
+class AdaptiveBatcher:
+    """Runs one pipeline stage in batches, shrinking the batch size on out-of-memory.
+
+    The reduced size sticks for later calls, so a stage that ran out of memory
+    once does not keep retrying the size that failed.
+    """
+
+    def __init__(self, name, batch_size):
+        self.name = name
+        self.batch_size = max(1, batch_size)
+
+    def run(self, fn, *sequences):
+        """Return ``[fn(*chunk) for each chunk]`` over aligned slices of ``sequences``.
+
+        On a RuntimeError/MemoryError the failed chunk is retried at half its
+        size; chunks that already succeeded are not run again.
+        """
+        results = []
+        start, total = 0, len(sequences[0])
+        while start < total:
+            end = min(start + self.batch_size, total)
+            try:
+                results.append(fn(*(sequence[start:end] for sequence in sequences)))
+            except (RuntimeError, MemoryError) as e:
+                if end - start == 1:
+                    raise
+                self.batch_size = (end - start) // 2
+                logger.warning(f"{self.name}: {type(e).__name__} at batch size {end - start}, "
+                               f"retrying from item {start} with batch size {self.batch_size}")
+                continue
+            start = end
+        return results
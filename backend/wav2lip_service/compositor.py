@@ -0,0 +1,115 @@
+"""
+Batched paste-back of Wav2Lip predictions into their full frames.
+
+Predictions are grouped by face box and blended into their frames through a
+feather mask, built once per box size, that fades out the edge of the box so
+the pasted face has no hard rectangular seam. StaticCanvas does the same for
+a still avatar while rewriting only the face box of one reusable frame.
+"""
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+class Compositor:
+    """Paste predicted faces back into frames.
+
+    Args:
+        feather: Width of the blended border as a fraction of the box's shorter
+            side. 0 pastes the hard rectangle, like the original Wav2Lip.
+        max_masks: Number of per-box-size masks kept (LRU)
+    """
+
+    def __init__(self, feather=0.1, max_masks=16):
+        self.feather = feather
+        self.max_masks = max(1, max_masks)
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def mask(self, height, width):
+        """Return the (alpha, 1 - alpha) pair of (height, width) float32 masks, or None for a hard paste."""
+        if self.feather <= 0:
+            return None
+
+        key = (height, width)
+        with self._lock:
+            masks = self._masks.get(key)
+            if masks is not None:
+                self._masks.move_to_end(key)
+                return masks
+
+        border = max(1, int(round(self.feather * min(height, width))))
+        # Ramps from 1/border at the edge of the box to 1 once ``border`` pixels inside
+        ramp_y = np.minimum(np.arange(1, height + 1), np.arange(height, 0, -1)) / border
+        ramp_x = np.minimum(np.arange(1, width + 1), np.arange(width, 0, -1)) / border
+        alpha = np.minimum.outer(np.minimum(ramp_y, 1), np.minimum(ramp_x, 1)).astype(np.float32)
+        masks = (alpha, 1 - alpha)
+
+        with self._lock:
+            self._masks[key] = masks
+            while len(self._masks) > self.max_masks:
+                self._masks.popitem(last=False)
+        return masks
+
+    def paste(self, frames, preds, boxes):
+        """Blend ``preds`` into ``frames`` in place.
+
+        Args:
+            frames: Sequence of (H, W, 3) uint8 frames, modified in place
+            preds: (N, h, w, 3) predictions with values in [0, 255]
+            boxes: (y1, y2, x1, x2) of each prediction in its frame
+        """
+        preds = np.asarray(preds).astype(np.uint8)
+
+        groups = OrderedDict()
+        for i, box in enumerate(boxes):
+            groups.setdefault(tuple(int(v) for v in box), []).append(i)
+
+        for (y1, y2, x1, x2), indices in groups.items():
+            size = (x2 - x1, y2 - y1)
+            masks = self.mask(y2 - y1, x2 - x1)
+            for i in indices:
+                region = frames[i][y1:y2, x1:x2]
+                face = cv2.resize(preds[i], size)
+                if masks is None:
+                    region[...] = face
+                else:
+                    # cv2.blendLinear is several times faster than the same blend in NumPy
+                    region[...] = cv2.blendLinear(face, np.ascontiguousarray(region), masks[0], masks[1])
+
+
+class StaticCanvas:
+    """Reusable output buffer for a static avatar.
+
+    Only the face box changes between frames of a still image, so each frame
+    rewrites that box (blended over the untouched base pixels) in one buffer
+    instead of copying the full frame. With ``overlay`` the buffer is just the
+    box, for clients that draw it over the still image themselves.
+
+    ``render`` returns the same array every time; write it out before the
+    next call.
+    """
+
+    def __init__(self, compositor, base, box, overlay=False):
+        y1, y2, x1, x2 = self.box = tuple(int(v) for v in box)
+        self.size = (x2 - x1, y2 - y1)
+        self.base_region = np.ascontiguousarray(base[y1:y2, x1:x2])
+        self.masks = compositor.mask(y2 - y1, x2 - x1)
+
+        if overlay:
+            self.frame = self.base_region.copy()
+            self.region = self.frame
+        else:
+            self.frame = base.copy()
+            self.region = self.frame[y1:y2, x1:x2]
+
+    def render(self, pred):
+        """Composite one (h, w, 3) prediction in [0, 255] and return the output buffer."""
+        face = cv2.resize(pred.astype(np.uint8), self.size)
+        if self.masks is None:
+            self.region[...] = face
+        else:
+            self.region[...] = cv2.blendLinear(face, self.base_region, self.masks[0], self.masks[1])
+        return self.frame
@@ -0,0 +1,70 @@
+"""
+Export the S3FD face detector to ONNX and OpenVINO IR.
+
+The exported models keep the batch, height and width dimensions dynamic, so
+one file serves every frame size. Select them at runtime with
+S3FD_BACKEND=openvino (or S3FD_BACKEND=onnx for onnxruntime).
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+import torch
+
+from face_detection.detection.sfd.net_s3fd import s3fd
+from face_detection.detection.sfd.backends import OUTPUT_NAMES
+
+SFD_DIR = Path(__file__).parent / "face_detection" / "detection" / "sfd"
+
+
+def convert():
+    checkpoint_path = SFD_DIR / "s3fd.pth"
+    if not checkpoint_path.exists():
+        print(f"Checkpoint not found at {checkpoint_path}. Run setup.py first.")
+        sys.exit(1)
+
+    print(f"Loading checkpoint from {checkpoint_path}")
+    model = s3fd()
+    model.load_state_dict(torch.load(checkpoint_path, map_location=torch.device('cpu')))
+    model.eval()
+
+    # Mean-subtracted BGR image, (Batch, Channel, Height, Width)
+    dummy_input = torch.randn(1, 3, 256, 256)
+    dynamic_axes = {"input": {0: "batch", 2: "height", 3: "width"}}
+    for name in OUTPUT_NAMES:
+        dynamic_axes[name] = {0: "batch", 2: f"{name}_height", 3: f"{name}_width"}
+
+    onnx_path = SFD_DIR / "s3fd.onnx"
+    print(f"Exporting to ONNX: {onnx_path}...")
+    torch.onnx.export(
+        model,
+        dummy_input,
+        str(onnx_path),
+        verbose=False,
+        input_names=["input"],
+        output_names=OUTPUT_NAMES,
+        dynamic_axes=dynamic_axes,
+        opset_version=11
+    )
+    print("ONNX export complete.")
+
+    print("Converting to OpenVINO IR...")
+    cmd = [
+        sys.executable, "-m", "openvino.tools.ovc",
+        str(onnx_path),
+        "--output_model", str(SFD_DIR / "s3fd_openvino"),
+        "--compress_to_fp16"
+    ]
+
+    print(f"Running: {' '.join(cmd)}")
+    try:
+        subprocess.check_call(cmd)
+        print("OpenVINO conversion complete.")
+        print(f"Model saved to {SFD_DIR / 's3fd_openvino.xml'}")
+    except subprocess.CalledProcessError as e:
+        print(f"OpenVINO conversion failed: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    convert()
@@ -0,0 +1,217 @@
+"""
+In-process Wav2Lip engine.
+
+Loads the Wav2Lip checkpoints and the S3FD face detector once and keeps them
+in memory, so lip-sync requests no longer pay for a Python process, the torch
+import and the model loads on every call.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+import audio
+import face_detection
+from avatar_cache import AvatarCache
+from compositor import Compositor, StaticCanvas
+from batch_planner import AdaptiveBatcher, plan_batch_size, resolve_budget, wav2lip_sample_bytes
+from models import Wav2Lip
+from video_encoder import FFmpegEncoder
+
+logger = logging.getLogger(__name__)
+
+SERVICE_DIR = Path(__file__).parent
+
+# quality -> checkpoint file name
+CHECKPOINTS = {
+    "base": "wav2lip.pth",
+    "gan": "wav2lip_gan.pth",
+}
+
+# Everything about an avatar that does not depend on the audio:
+# frame - decoded BGR image, face_input - (96, 96, 6) masked+reference face in [0, 1],
+# box - (y1, y2, x1, x2) of the padded face in ``frame``,
+# face_feats - quality -> face-encoder features, filled in on first use
+PreparedAvatar = namedtuple("PreparedAvatar", ["frame", "face_input", "box", "face_feats"])
+
+
+class Wav2LipEngine:
+    """Long-lived Wav2Lip pipeline: face detection, generator and video encoding."""
+
+    img_size = 96
+    mel_step_size = 16
+
+    def __init__(self, checkpoints_dir, device=None, fps=25., pads=(0, 10, 0, 0),
+                 wav2lip_batch_size=128, avatar_cache_size=32, ram_budget_mb=0,
+                 feather=0.1):
+        self.checkpoints_dir = Path(checkpoints_dir)
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.fps = fps
+        self.pads = pads
+        self.wav2lip_batch_size = wav2lip_batch_size
+        self.ram_budget_mb = ram_budget_mb
+
+        self.models = {}
+        self.detector = None
+        self.load_times = {}
+        self.avatars = AvatarCache(avatar_cache_size)
+        self.compositor = Compositor(feather)
+        # torch models are shared between requests; run one forward pass at a time
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load every available checkpoint and the face detector."""
+        self.detector = face_detection.get_detector(device=self.device)
+        self.load_times["s3fd"] = self.detector.load_time
+        logger.info(f"Face detector loaded in {self.load_times['s3fd']:.2f}s")
+
+        for quality, checkpoint in CHECKPOINTS.items():
+            path = self.checkpoints_dir / checkpoint
+            if not path.exists():
+                logger.warning(f"Checkpoint {checkpoint} not found, quality '{quality}' disabled")
+                continue
+            start = time.perf_counter()
+            self.models[quality] = self._load_model(path)
+            self.load_times[checkpoint] = time.perf_counter() - start
+            logger.info(f"Loaded {checkpoint} in {self.load_times[checkpoint]:.2f}s on {self.device}")
+
+    @property
+    def ready(self):
+        return self.detector is not None and bool(self.models)
+
+    def has_model(self, quality):
+        return quality in self.models
+
+    def _load_model(self, path):
+        if self.device == 'cuda':
+            checkpoint = torch.load(path)
+        else:
+            checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+        s = checkpoint["state_dict"]
+        new_s = {}
+        for k, v in s.items():
+            new_s[k.replace('module.', '')] = v
+
+        model = Wav2Lip()
+        model.load_state_dict(new_s)
+        model = model.to(self.device)
+        return model.eval()
+
+    def face_detect(self, frame):
+        """Return the padded face crop and its (y1, y2, x1, x2) box for a single frame."""
+        rect = self.detector.get_detections_for_batch(np.array([frame]))[0]
+        if rect is None:
+            raise ValueError('Face not detected! Ensure the image contains a face.')
+
+        pady1, pady2, padx1, padx2 = self.pads
+        y1 = max(0, rect[1] - pady1)
+        y2 = min(frame.shape[0], rect[3] + pady2)
+        x1 = max(0, rect[0] - padx1)
+        x2 = min(frame.shape[1], rect[2] + padx2)
+
+        return frame[y1:y2, x1:x2], (y1, y2, x1, x2)
+
+    def prepare_avatar(self, image):
+        """Decode, detect and build the masked 6-channel face input for an avatar image."""
+        frame = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise ValueError("Invalid image")
+
+        with self._lock:
+            face, box = self.face_detect(frame)
+
+        face = cv2.resize(face, (self.img_size, self.img_size))
+        face_masked = face.copy()
+        face_masked[self.img_size//2:] = 0
+        face_input = np.concatenate((face_masked, face), axis=2) / 255.
+
+        return PreparedAvatar(frame, face_input, box, {})
+
+    def register_avatar(self, image):
+        """Preprocess an avatar (or reuse the cached one) and return its ID."""
+        avatar_id, _ = self.avatars.get_or_create(image, self.prepare_avatar)
+        return avatar_id
+
+    def resolve_avatar(self, image):
+        """Return the PreparedAvatar for encoded image bytes (cached after the first call) or pass one through."""
+        if isinstance(image, PreparedAvatar):
+            return image
+        _, avatar = self.avatars.get_or_create(image, self.prepare_avatar)
+        return avatar
+
+    def get_avatar(self, avatar_id):
+        """Return the cached PreparedAvatar for ``avatar_id`` or None if unknown/evicted."""
+        return self.avatars.get(avatar_id)
+
+    def face_features(self, avatar, quality):
+        """Face-encoder features of ``avatar`` for ``quality``, computed once and kept with the avatar.
+
+        Must be called with ``self._lock`` held.
+        """
+        feats = avatar.face_feats.get(quality)
+        if feats is None:
+            face = torch.FloatTensor(np.transpose(avatar.face_input, (2, 0, 1))[np.newaxis]).to(self.device)
+            with torch.no_grad():
+                feats = self.models[quality].encode_face(face)
+            avatar.face_feats[quality] = feats
+        return feats
+
+    def generate(self, image, audio_data, quality="base", overlay=False):
+        """Lip-sync a static avatar to an audio clip.
+
+        Args:
+            image: Encoded image bytes (JPG/PNG) or a PreparedAvatar from the cache
+            audio_data: Encoded audio bytes (WAV/MP3)
+            quality: "base" or "gan"
+            overlay: Encode only the face box (``avatar.box``) for the client to draw
+                over the still image, instead of full frames
+
+        Returns:
+            (mp4_bytes, duration_ms)
+        """
+        if quality not in self.models:
+            raise KeyError(f"Model {CHECKPOINTS.get(quality, quality)} not loaded")
+
+        avatar = self.resolve_avatar(image)
+
+        wav = audio.load_wav_bytes(audio_data, 16000)
+
+        mel = audio.melspectrogram(wav)
+        if np.isnan(mel.reshape(-1)).sum() > 0:
+            raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
+        mels = audio.mel_chunks(mel, self.fps, self.mel_step_size, pad_last=True)
+
+        model = self.models[quality]
+        # The avatar is a still image: only the face box of one reused frame is rewritten per step
+        canvas = StaticCanvas(self.compositor, avatar.frame, avatar.box, overlay=overlay)
+        frame_h, frame_w = canvas.frame.shape[:-1]
+        batch_size = plan_batch_size("Wav2Lip", wav2lip_sample_bytes(frame_h, frame_w), self.wav2lip_batch_size,
+                                     resolve_budget(self.ram_budget_mb, self.device))
+        batcher = AdaptiveBatcher("Wav2Lip", batch_size)
+
+        def predict(mel_batch):
+            # ``mels`` is the (N, 1, 80, 16) array from ``audio.mel_chunks``, already in NCHW layout
+            mel_batch = torch.from_numpy(mel_batch).to(self.device)
+            with torch.no_grad():
+                pred = model.decode(mel_batch, face_feats)
+            return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+        # Frames go straight into ffmpeg, which muxes the audio in the same pass
+        with FFmpegEncoder(frame_w, frame_h, self.fps, audio_bytes=audio_data) as encoder:
+            with self._lock:
+                # The face is the same in every frame: encode it once, then only run audio encoder + decoder
+                face_feats = self.face_features(avatar, quality)
+                for start in range(0, len(mels), batch_size):
+                    # On out-of-memory only this batch is split and retried
+                    pred = np.concatenate(batcher.run(predict, mels[start : start + batch_size]))
+                    for p in pred:
+                        encoder.write(canvas.render(p))
+
+            video_data = encoder.finish()
+
+        return video_data, int(len(mels) / self.fps * 1000)
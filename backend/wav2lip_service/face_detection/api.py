@@ -1,5 +1,7 @@
 from __future__ import print_function
 import os
+import threading
+import time
 import torch
 from torch.utils.model_zoo import load_url
 from enum import Enum
@@ -12,6 +14,11 @@ except BaseException:
 
 from .models import FAN, ResNetDepth
 from .utils import *
+from .detection import sfd
+
+FACE_DETECTORS = {
+    'sfd': sfd.FaceDetector,
+}
 
 
 class LandmarksType(Enum):
@@ -57,13 +64,17 @@ class FaceAlignment:
             torch.backends.cudnn.benchmark = True
 
         # Get the face detector
-        face_detector_module = __import__('face_detection.detection.' + face_detector,
-                                          globals(), locals(), [face_detector], 0)
-        self.face_detector = face_detector_module.FaceDetector(device=device, verbose=verbose)
+        start = time.perf_counter()
+        self.face_detector = FACE_DETECTORS[face_detector](device=device, verbose=verbose)
+        self.load_time = time.perf_counter() - start
+
+        # One forward pass at a time, so a shared instance can serve several threads
+        self._lock = threading.Lock()
 
     def get_detections_for_batch(self, images):
         images = images[..., ::-1]
-        detected_faces = self.face_detector.detect_from_batch(images.copy())
+        with self._lock:
+            detected_faces = self.face_detector.detect_from_batch(images.copy())
         results = []
 
         for i, d in enumerate(detected_faces):
@@ -76,4 +87,27 @@ class FaceAlignment:
             x1, y1, x2, y2 = map(int, d[:-1])
             results.append((x1, y1, x2, y2))
 
-        return results
\ No newline at end of file
+        return results
+
+
+# Process-wide detectors, created on first use and shared by every caller
+_detectors = {}
+_detectors_lock = threading.Lock()
+
+
+def get_detector(device='cuda', face_detector='sfd'):
+    """Return the shared FaceAlignment for ``(face_detector, device)``, loading it on first use."""
+    key = (face_detector, device)
+    with _detectors_lock:
+        detector = _detectors.get(key)
+        if detector is None:
+            detector = FaceAlignment(LandmarksType._2D, device=device, flip_input=False,
+                                     face_detector=face_detector)
+            _detectors[key] = detector
+    return detector
+
+
+def loaded_detectors():
+    """Load time in seconds of every detector loaded so far, keyed by ``'<name>:<device>'``."""
+    with _detectors_lock:
+        return {'{}:{}'.format(*key): detector.load_time for key, detector in _detectors.items()}
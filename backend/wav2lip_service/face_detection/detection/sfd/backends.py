@@ -0,0 +1,50 @@
+"""
+Compiled CPU backends for the S3FD network.
+
+Each backend stands in for the torch ``s3fd`` module in ``batch_detect``: it
+takes an (N, 3, H, W) float tensor and returns the twelve head outputs
+(cls1, reg1, ..., cls6, reg6) as CPU tensors. The models are exported with
+dynamic batch and spatial dimensions by ``convert_s3fd.py``.
+"""
+import os
+
+import numpy as np
+import torch
+
+SFD_DIR = os.path.dirname(os.path.abspath(__file__))
+
+OUTPUT_NAMES = ['{}{}'.format(kind, i) for i in range(1, 7) for kind in ('cls', 'reg')]
+
+
+class OpenVINOS3FD:
+    def __init__(self, path=os.path.join(SFD_DIR, 's3fd_openvino.xml'), device_name='CPU'):
+        import openvino.runtime as ov
+
+        core = ov.Core()
+        self.compiled_model = core.compile_model(model=core.read_model(model=path), device_name=device_name)
+        self.outputs = [self.compiled_model.output(name) for name in OUTPUT_NAMES]
+        # Callers serialize detections (FaceAlignment holds a lock), so one request is enough
+        self.infer_request = self.compiled_model.create_infer_request()
+
+    def __call__(self, imgs):
+        results = self.infer_request.infer({0: imgs.cpu().numpy()})
+        # Copy out of the request's buffers before the next inference reuses them
+        return [torch.from_numpy(np.array(results[output])) for output in self.outputs]
+
+
+class ONNXS3FD:
+    def __init__(self, path=os.path.join(SFD_DIR, 's3fd.onnx')):
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, imgs):
+        outputs = self.session.run(OUTPUT_NAMES, {self.input_name: imgs.cpu().numpy()})
+        return [torch.from_numpy(output) for output in outputs]
+
+
+BACKENDS = {
+    'openvino': OpenVINOS3FD,
+    'onnx': ONNXS3FD,
+}
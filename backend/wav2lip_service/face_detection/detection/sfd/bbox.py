@@ -10,6 +10,11 @@ import argparse
 import numpy as np
 import torch
 
+try:
+    from torchvision.ops import batched_nms as tv_batched_nms
+except BaseException:
+    tv_batched_nms = None
+
 try:
     from iou import IOU
 except BaseException:
@@ -64,6 +69,43 @@ def nms(dets, thresh):
     return keep
 
 
+def batch_nms(bboxlists, thresh, score_thresh=0.5):
+    """NMS over every image of a batch in one call.
+
+    Args:
+        bboxlists: (num_boxes, batch, 5) array from ``batch_detect``
+        thresh: IoU above which the lower-scoring box is dropped
+        score_thresh: Boxes scoring at or below this are discarded
+    Return:
+        list with, for each image, an (n, 5) array of kept boxes in decreasing score order
+    """
+    num_images = bboxlists.shape[1]
+    # NMS never lets a box suppress a higher-scoring one, so dropping the boxes
+    # below score_thresh first gives the same result on far fewer boxes
+    box_idx, img_idx = np.nonzero(bboxlists[:, :, 4] > score_thresh)
+    dets = bboxlists[box_idx, img_idx]
+    if 0 == len(dets):
+        return [dets[:0] for _ in range(num_images)]
+
+    if tv_batched_nms is not None:
+        t = torch.from_numpy(np.ascontiguousarray(dets, dtype=np.float32))
+        # Inclusive x2/y2 like ``nms`` (area = (x2 - x1 + 1) * (y2 - y1 + 1)); only the IoU sees the shift
+        boxes = t[:, :4].clone()
+        boxes[:, 2:] += 1
+        keep = tv_batched_nms(boxes, t[:, 4], torch.from_numpy(img_idx), thresh).numpy()
+    else:
+        # Move each image's boxes to its own region so boxes of different images never overlap
+        span = dets[:, :4].max() - dets[:, :4].min() + 2
+        shifted = dets.copy()
+        shifted[:, :4] += (img_idx * span)[:, np.newaxis]
+        keep = np.asarray(nms(shifted, thresh), dtype=np.int64)
+
+    # Group by image; the stable sort keeps each image's boxes in score order
+    keep = keep[np.argsort(img_idx[keep], kind='stable')]
+    counts = np.bincount(img_idx[keep], minlength=num_images)
+    return np.split(dets[keep], np.cumsum(counts)[:-1])
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
@@ -12,50 +12,61 @@ import numpy as np
 
 import scipy.io as sio
 import zipfile
+import threading
+from collections import OrderedDict
 from .net_s3fd import s3fd
 from .bbox import *
 
 
-def detect(net, img, device):
-    img = img - np.array([104, 117, 123])
-    img = img.transpose(2, 0, 1)
-    img = img.reshape((1,) + img.shape)
+def prior_grid(fh, fw, stride):
+    """Center-offset priors (cx, cy, w, h) of every cell of one (fh, fw) S3FD head, row-major.
 
-    if 'cuda' in device:
-        torch.backends.cudnn.benchmark = True
+    Returns a (fh * fw, 4) tensor, so cell ``h * fw + w`` has the prior the
+    detector places at ``stride / 2 + (w, h) * stride`` with a ``stride * 4`` anchor.
+    """
+    priors = torch.empty(fh, fw, 4)
+    priors[..., 0] = (torch.arange(fw, dtype=torch.float32) * stride + stride / 2).view(1, fw)
+    priors[..., 1] = (torch.arange(fh, dtype=torch.float32) * stride + stride / 2).view(fh, 1)
+    priors[..., 2:] = stride * 4
+    return priors.view(-1, 4)
 
-    img = torch.from_numpy(img).float().to(device)
-    BB, CC, HH, WW = img.size()
-    with torch.no_grad():
-        olist = net(img)
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[0, 1, hindex, windex]
-            loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
-            variances = [0.1, 0.2]
-            box = decode(loc, priors, variances)
-            x1, y1, x2, y2 = box[0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append([x1, y1, x2, y2, score])
-    bboxlist = np.array(bboxlist)
-    if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, 5))
+class PriorCache:
+    """Bounded LRU of the six prior grids, keyed by input (H, W).
 
-    return bboxlist
+    Avatar frames keep the same resolution from call to call, so the grids
+    only need to be built the first time a size is seen.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-def batch_detect(net, imgs, device):
+    def get(self, size, feature_sizes):
+        """Return the prior grids for an input ``size``, one per (fh, fw) in ``feature_sizes``."""
+        with self._lock:
+            grids = self._entries.get(size)
+            if grids is not None:
+                self._entries.move_to_end(size)
+                return grids
+
+        grids = [prior_grid(fh, fw, 2**(i + 2)) for i, (fh, fw) in enumerate(feature_sizes)]
+        with self._lock:
+            self._entries[size] = grids
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return grids
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def detect(net, img, device, prior_cache=None):
+    return batch_detect(net, img[np.newaxis], device, prior_cache)[:, 0]
+
+def batch_detect(net, imgs, device, prior_cache=None):
     imgs = imgs - np.array([104, 117, 123])
     imgs = imgs.transpose(0, 3, 1, 2)
 
@@ -67,31 +78,39 @@ def batch_detect(net, imgs, device):
     with torch.no_grad():
         olist = net(imgs)
 
-    bboxlist = []
     for i in range(len(olist) // 2):
         olist[i * 2] = F.softmax(olist[i * 2], dim=1)
     olist = [oelem.data.cpu() for oelem in olist]
+
+    # Head i has stride 2**(i + 2): 4,8,16,32,64,128
+    feature_sizes = [tuple(olist[i * 2].shape[2:]) for i in range(len(olist) // 2)]
+    if prior_cache is not None:
+        grids = prior_cache.get((HH, WW), feature_sizes)
+    else:
+        grids = [prior_grid(fh, fw, 2**(i + 2)) for i, (fh, fw) in enumerate(feature_sizes)]
+
+    # Gather the candidate cells of all six heads, then decode them in one call
+    locs, priors, scores = [], [], []
     for i in range(len(olist) // 2):
         ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-            variances = [0.1, 0.2]
-            box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
-    if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, BB, 5))
-
-    return bboxlist
+        score = ocls[:, 1].reshape(BB, -1)
+        # A cell is kept for the whole batch as soon as one image scores above the threshold
+        cells = (score > 0.05).any(0).nonzero(as_tuple=True)[0]
+        if len(cells) == 0:
+            continue
+        locs.append(oreg.reshape(BB, 4, -1)[:, :, cells].transpose(1, 2))
+        priors.append(grids[i][cells])
+        scores.append(score[:, cells])
+
+    if 0 == len(locs):
+        return np.zeros((1, BB, 5))
+
+    variances = [0.1, 0.2]
+    boxes = batch_decode(torch.cat(locs, 1), torch.cat(priors, 0).unsqueeze(0), variances)
+    bboxlist = torch.cat([boxes, torch.cat(scores, 1).unsqueeze(2)], 2)
+
+    # (num_boxes, BB, 5), the layout detect_from_batch expects
+    return bboxlist.transpose(0, 1).numpy()
 
 def flip_detect(net, img, device):
     img = cv2.flip(img, 1)
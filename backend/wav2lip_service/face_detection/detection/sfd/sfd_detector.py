@@ -1,4 +1,5 @@
 import os
+import logging
 import cv2
 from torch.utils.model_zoo import load_url
 
@@ -7,6 +8,7 @@ from ..core import FaceDetector
 from .net_s3fd import s3fd
 from .bbox import *
 from .detect import *
+from .backends import BACKENDS
 
 models_urls = {
     's3fd': 'https://www.adrianbulat.com/downloads/python-fan/s3fd-619a316812.pth',
@@ -14,24 +16,49 @@ models_urls = {
 
 
 class SFDDetector(FaceDetector):
-    def __init__(self, device, path_to_detector=os.path.join(os.path.dirname(os.path.abspath(__file__)), 's3fd.pth'), verbose=False):
+    """S3FD face detector.
+
+    ``backend`` selects the runtime: "torch" (default), or "openvino" / "onnx"
+    for the exported models from convert_s3fd.py. When not given it is read
+    from the S3FD_BACKEND environment variable.
+    """
+
+    def __init__(self, device, path_to_detector=os.path.join(os.path.dirname(os.path.abspath(__file__)), 's3fd.pth'), verbose=False,
+                 prior_cache_size=8, backend=None):
         super(SFDDetector, self).__init__(device, verbose)
 
-        # Initialise the face detector
-        if not os.path.isfile(path_to_detector):
-            model_weights = load_url(models_urls['s3fd'])
-        else:
-            model_weights = torch.load(path_to_detector)
+        self.backend = backend or os.environ.get('S3FD_BACKEND', 'torch')
+        if self.backend in BACKENDS:
+            try:
+                # Compiled backends run on the CPU whatever ``device`` is
+                self.face_detector = BACKENDS[self.backend]()
+            except ImportError as e:
+                # openvino / onnxruntime are optional extras (see requirements.txt)
+                logging.getLogger(__name__).warning(
+                    "S3FD backend '%s' is not available (%s), falling back to torch", self.backend, e)
+                self.backend = 'torch'
+        elif self.backend != 'torch':
+            raise ValueError('Unknown S3FD backend: {}'.format(self.backend))
+
+        if self.backend == 'torch':
+            # Initialise the face detector
+            if not os.path.isfile(path_to_detector):
+                model_weights = load_url(models_urls['s3fd'])
+            else:
+                model_weights = torch.load(path_to_detector)
 
-        self.face_detector = s3fd()
-        self.face_detector.load_state_dict(model_weights)
-        self.face_detector.to(device)
-        self.face_detector.eval()
+            self.face_detector = s3fd()
+            self.face_detector.load_state_dict(model_weights)
+            self.face_detector.to(device)
+            self.face_detector.eval()
+
+        # Anchor priors per input resolution, reused across detections
+        self.prior_cache = PriorCache(prior_cache_size)
 
     def detect_from_image(self, tensor_or_path):
         image = self.tensor_or_path_to_ndarray(tensor_or_path)
 
-        bboxlist = detect(self.face_detector, image, device=self.device)
+        bboxlist = detect(self.face_detector, image, device=self.device, prior_cache=self.prior_cache)
         keep = nms(bboxlist, 0.3)
         bboxlist = bboxlist[keep, :]
         bboxlist = [x for x in bboxlist if x[-1] > 0.5]
@@ -39,12 +66,9 @@ class SFDDetector(FaceDetector):
         return bboxlist
 
     def detect_from_batch(self, images):
-        bboxlists = batch_detect(self.face_detector, images, device=self.device)
-        keeps = [nms(bboxlists[:, i, :], 0.3) for i in range(bboxlists.shape[1])]
-        bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
-        bboxlists = [[x for x in bboxlist if x[-1] > 0.5] for bboxlist in bboxlists]
-
-        return bboxlists
+        bboxlists = batch_detect(self.face_detector, images, device=self.device,
+                                 prior_cache=self.prior_cache)
+        return batch_nms(bboxlists, 0.3, score_thresh=0.5)
 
     @property
     def reference_scale(self):
@@ -1,12 +1,14 @@
 from os import listdir, path
 import numpy as np
 import scipy, cv2, os, sys, argparse, audio
-import json, subprocess, random, string
+import json, subprocess, random, string, hashlib, logging
 from tqdm import tqdm
 from glob import glob
 import torch, face_detection
 from models import Wav2Lip
-import platform
+from video_encoder import FFmpegEncoder
+from compositor import Compositor, StaticCanvas
+from batch_planner import AdaptiveBatcher, plan_batch_size, resolve_budget, s3fd_sample_bytes, wav2lip_sample_bytes
 
 parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
 
@@ -31,6 +33,8 @@ parser.add_argument('--pads', nargs='+', type=int, default=[0, 10, 0, 0],
 parser.add_argument('--face_det_batch_size', type=int, 
 					help='Batch size for face detection', default=16)
 parser.add_argument('--wav2lip_batch_size', type=int, help='Batch size for Wav2Lip model(s)', default=128)
+parser.add_argument('--ram_budget_mb', type=int, default=int(os.getenv('WAV2LIP_RAM_BUDGET_MB', '0')),
+					help='Memory budget used to pick batch sizes (at most the sizes above). 0: half of the available memory')
 
 parser.add_argument('--resize_factor', default=1, type=int, 
 			help='Reduce the resolution by this factor. Sometimes, best results are obtained at 480p or 720p')
@@ -50,6 +54,21 @@ parser.add_argument('--rotate', default=False, action='store_true',
 parser.add_argument('--nosmooth', default=False, action='store_true',
 					help='Prevent smoothing face detections over a short temporal window')
 
+parser.add_argument('--feather', type=float, default=0.1,
+					help='Blend the pasted face into the frame over this fraction of the box size (0: hard paste)')
+
+parser.add_argument('--overlay', default=False, action='store_true',
+					help='Static input only: encode just the face box instead of full frames. Writes the base frame '
+					'and the box coordinates next to --outfile so a client can draw the overlay over the still image')
+
+parser.add_argument('--det_interval', type=int, default=1,
+					help='Run face detection on every Nth frame only and interpolate the boxes in between (1: every frame)')
+parser.add_argument('--motion_threshold', type=float, default=8.,
+					help='With --det_interval > 1, also detect on any frame whose mean absolute difference '
+					'from the last detected frame (grayscale, 0-255) exceeds this')
+parser.add_argument('--det_cache_dir', type=str, default='temp/face_det_cache',
+					help='Directory caching face detections per input video. Empty string disables the cache')
+
 args = parser.parse_args()
 args.img_size = 96
 
@@ -65,69 +84,196 @@ def get_smoothened_boxes(boxes, T):
 		boxes[i] = np.mean(window, axis=0)
 	return boxes
 
-def face_detect(images):
-	detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
-											flip_input=False, device=device)
+def detection_cache_path():
+	"""File caching the raw detections of --face, or None when the cache is disabled."""
+	if not args.det_cache_dir:
+		return None
+
+	h = hashlib.sha256()
+	with open(args.face, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+	# Options that change the frames, or which of them get detected, are part of the key
+	h.update(json.dumps([args.resize_factor, args.rotate, args.crop,
+						args.det_interval, args.motion_threshold]).encode())
+	return os.path.join(args.det_cache_dir, h.hexdigest() + '.npz')
+
+def is_image_input():
+	return args.face.split('.')[1] in ['jpg', 'png', 'jpeg']
+
+def read_frames(limit=None):
+	"""Decode --face frame by frame (after resize, rotate and crop), at most ``limit`` frames."""
+	if is_image_input():
+		yield cv2.imread(args.face)
+		return
+
+	video_stream = cv2.VideoCapture(args.face)
+	count = 0
+	try:
+		while limit is None or count < limit:
+			still_reading, frame = video_stream.read()
+			if not still_reading:
+				break
+			if args.resize_factor > 1:
+				frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
+
+			if args.rotate:
+				frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+
+			y1, y2, x1, x2 = args.crop
+			if x2 == -1: x2 = frame.shape[1]
+			if y2 == -1: y2 = frame.shape[0]
 
-	batch_size = args.face_det_batch_size
-	
-	while 1:
-		predictions = []
+			yield frame[y1:y2, x1:x2]
+			count += 1
+	finally:
+		video_stream.release()
+
+def cycle_frames(total, period=None):
+	"""Yield ``total`` frames, replaying the first ``period`` frames of --face (default: all) as often as needed.
+
+	The video is decoded again on every pass instead of being kept in memory.
+	"""
+	emitted = 0
+	while emitted < total:
+		count = 0
+		for frame in read_frames(min(period or total, total - emitted)):
+			yield frame
+			count += 1
+		if count == 0:
+			raise ValueError('Could not read any frame from --face')
+		emitted += count
+
+def thumbnail(image):
+	return cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (64, 64), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+def detect_face_rects(frames):
+	"""Return an (N, 4) array of raw (x1, y1, x2, y2) face boxes, one per frame of ``frames``.
+
+	Frames are consumed as a stream and only the pending detection batch is held.
+	With --det_interval > 1 a frame is detected every --det_interval frames, or
+	earlier when it differs from the last detected frame by more than
+	--motion_threshold; the last frame is always detected and the boxes in
+	between are interpolated.
+	"""
+	# Loaded once per process and reused by later calls
+	detector = face_detection.get_detector(device=device)
+	tracking = args.det_interval > 1
+
+	batcher = None
+	keyframes, key_images, predictions = [], [], []
+
+	def detect_pending():
 		try:
-			for i in tqdm(range(0, len(images), batch_size)):
-				predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
+			batches = batcher.run(lambda batch: detector.get_detections_for_batch(np.array(batch)), key_images)
 		except RuntimeError:
-			if batch_size == 1: 
-				raise RuntimeError('Image too big to run face detection on GPU. Please use the --resize_factor argument')
-			batch_size //= 2
-			print('Recovering from OOM error; New batch size: {}'.format(batch_size))
-			continue
-		break
-
-	results = []
+			raise RuntimeError('Image too big to run face detection. Please use the --resize_factor argument')
+		rects = [rect for batch in batches for rect in batch]
+
+		for rect, image in zip(rects, key_images):
+			if rect is None:
+				cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
+				raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
+		predictions.extend(rects)
+		key_images.clear()
+
+	num_frames = 0
+	reference = skipped = None
+	for i, frame in enumerate(tqdm(frames)):
+		num_frames = i + 1
+		if batcher is None:
+			h, w = frame.shape[:2]
+			batcher = AdaptiveBatcher('Face detection', plan_batch_size('Face detection', s3fd_sample_bytes(h, w),
+										args.face_det_batch_size, resolve_budget(args.ram_budget_mb, device)))
+
+		if tracking:
+			current = thumbnail(frame)
+			if i > 0 and i - keyframes[-1] < args.det_interval and np.abs(current - reference).mean() <= args.motion_threshold:
+				# Kept only in case it turns out to be the last frame
+				skipped = frame
+				continue
+			reference = current
+
+		keyframes.append(i)
+		key_images.append(frame)
+		skipped = None
+		if len(key_images) >= batcher.batch_size:
+			detect_pending()
+
+	if skipped is not None:
+		keyframes.append(num_frames - 1)
+		key_images.append(skipped)
+	if key_images:
+		detect_pending()
+
+	rects = np.array(predictions)
+	if len(keyframes) < num_frames:
+		print('Tracking mode: detected faces on {}/{} frames'.format(len(keyframes), num_frames))
+		# Linear interpolation of each coordinate between the detected frames
+		frame_ids = np.arange(num_frames)
+		rects = np.stack([np.interp(frame_ids, keyframes, rects[:, j]) for j in range(4)], axis=1)
+		rects = np.rint(rects).astype(int)
+	return rects
+
+def face_detect(frames, limit, frame_shape):
+	"""Return an (N, 4) array of padded, smoothed (y1, y2, x1, x2) face boxes.
+
+	``frames`` yields at most ``limit`` frames; it is not consumed when the
+	detections come from the cache.
+	"""
+	cache_path = detection_cache_path()
+	rects = None
+	if cache_path is not None and os.path.isfile(cache_path):
+		with np.load(cache_path) as cached:
+			# The cache may come from a longer run on the same video (frames are cut to the audio length)
+			if cached['complete'] or len(cached['rects']) >= limit:
+				print('Using cached face detections from {}'.format(cache_path))
+				rects = cached['rects'][:limit]
+
+	if rects is None:
+		rects = detect_face_rects(frames)
+		if cache_path is not None:
+			os.makedirs(args.det_cache_dir, exist_ok=True)
+			# complete: the video ended before ``limit``, so these are all of its frames
+			np.savez(cache_path, rects=rects, complete=len(rects) < limit)
+
 	pady1, pady2, padx1, padx2 = args.pads
-	for rect, image in zip(predictions, images):
-		if rect is None:
-			cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
-			raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
-
-		y1 = max(0, rect[1] - pady1)
-		y2 = min(image.shape[0], rect[3] + pady2)
-		x1 = max(0, rect[0] - padx1)
-		x2 = min(image.shape[1], rect[2] + padx2)
-		
-		results.append([x1, y1, x2, y2])
+	frame_h, frame_w = frame_shape[:2]
+	boxes = np.stack([np.maximum(0, rects[:, 0] - padx1),
+					  np.maximum(0, rects[:, 1] - pady1),
+					  np.minimum(frame_w, rects[:, 2] + padx2),
+					  np.minimum(frame_h, rects[:, 3] + pady2)], axis=1)
 
-	boxes = np.array(results)
 	if not args.nosmooth: boxes = get_smoothened_boxes(boxes, T=5)
-	results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
+	return boxes[:, [1, 3, 0, 2]]
 
-	del detector
-	return results 
+def static_datagen(frame, box, mels):
+	"""Yield Wav2Lip batches for a static avatar: the face input is built once, only the mels change.
 
-def datagen(frames, mels):
-	img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+	img_batch holds that single face input; the face encoder only needs to run on it once.
+	"""
+	y1, y2, x1, x2 = box
+	face = cv2.resize(frame[y1: y2, x1:x2], (args.img_size, args.img_size))
+	face_masked = face.copy()
+	face_masked[args.img_size//2:] = 0
+	face_input = np.concatenate((face_masked, face), axis=2) / 255.
 
-	if args.box[0] == -1:
-		if not args.static:
-			face_det_results = face_detect(frames) # BGR2RGB for CNN face detection
-		else:
-			face_det_results = face_detect([frames[0]])
-	else:
-		print('Using the specified bounding box instead of face detection...')
-		y1, y2, x1, x2 = args.box
-		face_det_results = [[f[y1: y2, x1:x2], (y1, y2, x1, x2)] for f in frames]
+	for start in range(0, len(mels), args.wav2lip_batch_size):
+		mel_batch = mels[start : start + args.wav2lip_batch_size, ..., np.newaxis]
 
-	for i, m in enumerate(mels):
-		idx = 0 if args.static else i%len(frames)
-		frame_to_save = frames[idx].copy()
-		face, coords = face_det_results[idx].copy()
+		yield face_input[np.newaxis], mel_batch, None, None
 
-		face = cv2.resize(face, (args.img_size, args.img_size))
+def datagen(frames, boxes, mels):
+	"""Yield Wav2Lip batches from a frame stream; ``boxes`` is cycled along with the video."""
+	img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+
+	for i, (frame, m) in enumerate(zip(frames, mels)):
+		y1, y2, x1, x2 = coords = tuple(boxes[i % len(boxes)])
+		face = cv2.resize(frame[y1: y2, x1:x2], (args.img_size, args.img_size))
 			
 		img_batch.append(face)
 		mel_batch.append(m)
-		frame_batch.append(frame_to_save)
+		frame_batch.append(frame)
 		coords_batch.append(coords)
 
 		if len(img_batch) >= args.wav2lip_batch_size:
@@ -178,41 +324,43 @@ def load_model(path):
 	model = model.to(device)
 	return model.eval()
 
+def predict_static(model, mel_batch, face_feats):
+	mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+
+	with torch.no_grad():
+		pred = model.decode(mel_batch, face_feats)
+
+	return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+def predict(model, img_batch, mel_batch):
+	img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
+	mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+
+	with torch.no_grad():
+		pred = model(mel_batch, img_batch)
+
+	return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
 def main():
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+
 	if not os.path.isfile(args.face):
 		raise ValueError('--face argument must be a valid path to video/image file')
 
-	elif args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-		full_frames = [cv2.imread(args.face)]
+	elif is_image_input():
 		fps = args.fps
 
 	else:
 		video_stream = cv2.VideoCapture(args.face)
 		fps = video_stream.get(cv2.CAP_PROP_FPS)
+		video_stream.release()
 
-		print('Reading video frames...')
-
-		full_frames = []
-		while 1:
-			still_reading, frame = video_stream.read()
-			if not still_reading:
-				video_stream.release()
-				break
-			if args.resize_factor > 1:
-				frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
-
-			if args.rotate:
-				frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
-
-			y1, y2, x1, x2 = args.crop
-			if x2 == -1: x2 = frame.shape[1]
-			if y2 == -1: y2 = frame.shape[0]
-
-			frame = frame[y1:y2, x1:x2]
+	first_frame = next(read_frames(1), None)
+	if first_frame is None:
+		raise ValueError('Could not read any frame from --face')
 
-			full_frames.append(frame)
-
-	print ("Number of frames available for inference: "+str(len(full_frames)))
+	if args.overlay and not args.static:
+		raise ValueError('--overlay needs a static input (an image or --static True)')
 
 	if not args.audio.endswith('.wav'):
 		print('Extracting raw audio...')
@@ -228,23 +376,38 @@ def main():
 	if np.isnan(mel.reshape(-1)).sum() > 0:
 		raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
 
-	mel_chunks = []
-	mel_idx_multiplier = 80./fps 
-	i = 0
-	while 1:
-		start_idx = int(i * mel_idx_multiplier)
-		if start_idx + mel_step_size > len(mel[0]):
-			mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-			break
-		mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-		i += 1
+	# One (80, 16) window per frame, gathered in a single allocation
+	mel_chunks = audio.mel_chunks(mel, fps, mel_step_size, pad_last=True)[:, 0]
 
 	print("Length of mel chunks: {}".format(len(mel_chunks)))
 
-	full_frames = full_frames[:len(mel_chunks)]
-
-	batch_size = args.wav2lip_batch_size
-	gen = datagen(full_frames.copy(), mel_chunks)
+	if args.box[0] != -1:
+		print('Using the specified bounding box instead of face detection...')
+		boxes = np.array([args.box])
+	elif args.static:
+		boxes = face_detect([first_frame], 1, first_frame.shape)
+	else:
+		# Streams the first len(mel_chunks) frames through the detector without keeping them
+		boxes = face_detect(read_frames(len(mel_chunks)), len(mel_chunks), first_frame.shape)
+		print("Number of frames available for inference: "+str(len(boxes)))
+
+	frame_h, frame_w = first_frame.shape[:-1]
+	batch_size = args.wav2lip_batch_size = plan_batch_size('Wav2Lip', wav2lip_sample_bytes(frame_h, frame_w),
+														   args.wav2lip_batch_size, resolve_budget(args.ram_budget_mb, device))
+	# Splits a batch further (and resumes from it) if the model runs out of memory
+	wav2lip_batcher = AdaptiveBatcher('Wav2Lip', batch_size)
+	compositor = Compositor(args.feather)
+
+	if args.static:
+		# One base frame: each step only rewrites the face box of a reused buffer
+		canvas = StaticCanvas(compositor, first_frame, boxes[0], overlay=args.overlay)
+		out_h, out_w = canvas.frame.shape[:-1]
+		gen = static_datagen(first_frame, canvas.box, mel_chunks)
+	else:
+		# Decoded again lazily, looping over the detected frames for audio longer than the video
+		frame_stream = cycle_frames(len(mel_chunks), None if args.box[0] != -1 else len(boxes))
+		out_h, out_w = frame_h, frame_w
+		gen = datagen(frame_stream, boxes, mel_chunks)
 
 	for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, 
 											total=int(np.ceil(float(len(mel_chunks))/batch_size)))):
@@ -252,29 +415,36 @@ def main():
 			model = load_model(args.checkpoint_path)
 			print ("Model loaded")
 
-			frame_h, frame_w = full_frames[0].shape[:-1]
-			out = cv2.VideoWriter('temp/result.avi', 
-									cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
+			# Single pass: raw frames are piped to ffmpeg, which encodes and muxes the audio
+			out = FFmpegEncoder(out_w, out_h, fps, audio_path=args.audio, output_path=args.outfile)
 
-		img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-		mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+			if args.static:
+				# Same face for every frame: run the face encoder once and reuse its features
+				with torch.no_grad():
+					face_feats = model.encode_face(torch.FloatTensor(np.transpose(img_batch[:1], (0, 3, 1, 2))).to(device))
 
-		with torch.no_grad():
-			pred = model(mel_batch, img_batch)
-
-		pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+		if args.static:
+			pred = np.concatenate(wav2lip_batcher.run(lambda mels: predict_static(model, mels, face_feats), mel_batch))
+		else:
+			pred = np.concatenate(wav2lip_batcher.run(lambda faces, mels: predict(model, faces, mels), img_batch, mel_batch))
 		
-		for p, f, c in zip(pred, frames, coords):
-			y1, y2, x1, x2 = c
-			p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-
-			f[y1:y2, x1:x2] = p
-			out.write(f)
-
-	out.release()
-
-	command = 'ffmpeg -y -i {} -i {} -strict -2 -q:v 1 {}'.format(args.audio, 'temp/result.avi', args.outfile)
-	subprocess.call(command, shell=platform.system() != 'Windows')
+		if args.static:
+			for p in pred:
+				out.write(canvas.render(p))
+		else:
+			compositor.paste(frames, pred, coords)
+			for f in frames:
+				out.write(f)
+
+	out.finish()
+
+	if args.overlay:
+		base_path = os.path.splitext(args.outfile)[0] + '_base.png'
+		cv2.imwrite(base_path, first_frame)
+		y1, y2, x1, x2 = canvas.box
+		with open(os.path.splitext(args.outfile)[0] + '.json', 'w') as f:
+			json.dump({'video': args.outfile, 'base_frame': base_path, 'fps': fps, 'frames': len(mel_chunks),
+					   'box': {'x': x1, 'y': y1, 'width': x2 - x1, 'height': y2 - y1}}, f, indent=2)
 
 if __name__ == '__main__':
 	main()
@@ -2,15 +2,16 @@
 FastAPI service for Wav2Lip lip-sync generation.
 Port: 8300
 """
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import Response
 from pathlib import Path
+from typing import Optional
 import base64
-import tempfile
-import subprocess
-import os
 import logging
+import os
+
+from engine import CHECKPOINTS, Wav2LipEngine
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,6 +25,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Duration-Ms", "X-Overlay-Box"],
 )
 
 # Paths
@@ -32,6 +34,25 @@ CHECKPOINTS_DIR = SERVICE_DIR / "checkpoints"
 TEMP_DIR = SERVICE_DIR / "temp"
 TEMP_DIR.mkdir(exist_ok=True)
 
+# Preprocessed avatars kept in memory (LRU)
+AVATAR_CACHE_SIZE = int(os.getenv("AVATAR_CACHE_SIZE", "32"))
+# Memory budget for picking batch sizes (0: half of the available memory)
+RAM_BUDGET_MB = int(os.getenv("WAV2LIP_RAM_BUDGET_MB", "0"))
+# Width of the blended border around the pasted face, as a fraction of the box (0: hard paste)
+FEATHER = float(os.getenv("WAV2LIP_FEATHER", "0.1"))
+
+engine = Wav2LipEngine(CHECKPOINTS_DIR, avatar_cache_size=AVATAR_CACHE_SIZE, ram_budget_mb=RAM_BUDGET_MB,
+                       feather=FEATHER)
+
+
+@app.on_event("startup")
+def load_engine():
+    """Load the Wav2Lip checkpoints and face detector once for the whole process."""
+    try:
+        engine.load()
+    except Exception as e:
+        logger.error(f"Failed to load Wav2Lip engine: {e}")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -41,21 +62,70 @@ async def health_check():
         "s3fd.pth": (SERVICE_DIR / "face_detection" / "detection" / "sfd" / "s3fd.pth").exists(),
     }
     
-    # Service is ready if we have at least one Wav2Lip model + face detector
-    service_ready = (models_exist["wav2lip_gan.pth"] or models_exist["wav2lip.pth"]) and models_exist["s3fd.pth"]
+    # Service is ready once the engine holds at least one Wav2Lip model + face detector
+    service_ready = engine.ready
     
     return {
         "status": "healthy",
         "models": models_exist,
         "all_models_ready": all(models_exist.values()),
-        "service_ready": service_ready
+        "service_ready": service_ready,
+        "loaded_qualities": sorted(engine.models),
+        "load_times_s": engine.load_times,
+        "avatar_cache": engine.avatars.stats()
     }
 
+def read_input(upload, base64_value):
+    """Bytes of a form input sent either as a multipart file or as a legacy base64 field."""
+    if upload is not None:
+        return upload.file.read()
+    if base64_value:
+        return base64.b64decode(base64_value)
+    return None
+
+def wants_binary_response(request, response_format):
+    """Raw video/mp4 when asked for explicitly or via the Accept header, JSON + base64 otherwise."""
+    if response_format:
+        return response_format == "binary"
+    return "video/mp4" in request.headers.get("accept", "")
+
+@app.post("/avatars")
+def register_avatar(
+    avatar_image: Optional[str] = Form(None),  # base64
+    avatar_file: Optional[UploadFile] = File(None)  # multipart alternative to avatar_image
+):
+    """
+    Preprocess an avatar once (face detection, crop, masked face input) and cache it.
+
+    Returns:
+        avatar_id to send to /generate instead of the image
+    """
+    if not engine.ready:
+        raise HTTPException(status_code=503, detail="Wav2Lip engine not loaded")
+
+    image_data = read_input(avatar_file, avatar_image)
+    if not image_data:
+        raise HTTPException(status_code=400, detail="avatar_image or avatar_file is required")
+
+    try:
+        avatar_id = engine.register_avatar(image_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    logger.info(f"Registered avatar {avatar_id}")
+    return {"avatar_id": avatar_id}
+
 @app.post("/generate")
-async def generate_lipsync(
-    avatar_image: str = Form(...),  # base64
-    audio: str = Form(...),          # base64
-    quality: str = Form("base")      # "base" or "gan"
+def generate_lipsync(
+    request: Request,
+    avatar_image: Optional[str] = Form(None),  # base64
+    audio: Optional[str] = Form(None),         # base64
+    quality: str = Form("base"),     # "base" or "gan"
+    avatar_id: Optional[str] = Form(None),  # from /avatars, replaces avatar_image
+    avatar_file: Optional[UploadFile] = File(None),  # multipart alternative to avatar_image
+    audio_file: Optional[UploadFile] = File(None),   # multipart alternative to audio
+    response_format: Optional[str] = Form(None),     # "json" or "binary"
+    render: str = Form("full")                       # "full" or "overlay"
 ):
     """
     Generate lip-synced video from avatar image and audio.
@@ -64,85 +134,68 @@ async def generate_lipsync(
         avatar_image: Base64 encoded image (JPG/PNG)
         audio: Base64 encoded audio (WAV/MP3)
         quality: "base" (faster) or "gan" (better quality)
+        avatar_id: ID returned by /avatars, used instead of avatar_image
+        avatar_file / audio_file: Raw multipart uploads instead of the base64 fields
+        response_format: "binary" for a raw video/mp4 body (also chosen by
+            ``Accept: video/mp4``), "json" for the base64 contract
+        render: "overlay" encodes only the face box; draw it over the avatar
+            image at the returned box ("box" in JSON, X-Overlay-Box: x,y,width,height)
     
     Returns:
-        Base64 encoded MP4 video
+        Base64 encoded MP4 video, or the MP4 bytes for binary responses
     """
     try:
         logger.info(f"Generating lip-sync video (quality={quality})")
         
-        # Decode inputs
-        image_data = base64.b64decode(avatar_image)
-        audio_data = base64.b64decode(audio)
-        
-        # Create temp files
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False, dir=TEMP_DIR) as img_file:
-            img_file.write(image_data)
-            img_path = img_file.name
-        
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False, dir=TEMP_DIR) as aud_file:
-            aud_file.write(audio_data)
-            aud_path = aud_file.name
-        
-        output_path = TEMP_DIR / f"result_{Path(img_path).stem}.mp4"
-        
-        # Select checkpoint
-        checkpoint = "wav2lip_gan.pth" if quality == "gan" else "wav2lip.pth"
-        checkpoint_path = CHECKPOINTS_DIR / checkpoint
+        # Resolve the avatar: a registered ID skips decoding and face detection
+        if avatar_id:
+            avatar = engine.get_avatar(avatar_id)
+            if avatar is None:
+                raise HTTPException(status_code=404, detail="Unknown avatar_id, register the avatar again")
+        else:
+            avatar = read_input(avatar_file, avatar_image)
+            if not avatar:
+                raise HTTPException(status_code=400, detail="Either avatar_image or avatar_id is required")
+
+        audio_data = read_input(audio_file, audio)
+        if not audio_data:
+            raise HTTPException(status_code=400, detail="audio or audio_file is required")
         
-        if not checkpoint_path.exists():
+        if render not in ("full", "overlay"):
+            raise HTTPException(status_code=400, detail=f"Unsupported render mode: {render}")
+
+        if not engine.has_model(quality):
+            checkpoint = CHECKPOINTS.get(quality, quality)
             raise HTTPException(status_code=500, detail=f"Model {checkpoint} not found")
         
-        # Run Wav2Lip inference
-        # Note: This assumes inference.py from Wav2Lip repo is in the same directory
-        cmd = [
-            "python", "inference.py",
-            "--checkpoint_path", str(checkpoint_path),
-            "--face", img_path,
-            "--audio", aud_path,
-            "--outfile", str(output_path),
-            "--resize_factor", "1",  # CPU optimization
-            "--fps", "25"  # Lower FPS for CPU
-        ]
-        
-        logger.info(f"Running: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd,
-            cwd=SERVICE_DIR,
-            capture_output=True,
-            text=True,
-            timeout=60  # 60s timeout
-        )
-        
-        if result.returncode != 0:
-            logger.error(f"Wav2Lip failed: {result.stderr}")
-            raise HTTPException(status_code=500, detail=f"Wav2Lip inference failed: {result.stderr}")
-        
-        # Read output video
-        if not output_path.exists():
-            raise HTTPException(status_code=500, detail="Output video not generated")
-        
-        with open(output_path, "rb") as f:
-            video_data = f.read()
+        # Run Wav2Lip inference in-process with the preloaded models
+        avatar = engine.resolve_avatar(avatar)
+        overlay = render == "overlay"
+        video_data, duration_ms = engine.generate(avatar, audio_data, quality, overlay=overlay)
+        y1, y2, x1, x2 = avatar.box
+        box = {"x": int(x1), "y": int(y1), "width": int(x2 - x1), "height": int(y2 - y1)}
         
+        logger.info("Lip-sync video generated successfully")
+        if wants_binary_response(request, response_format):
+            headers = {"X-Duration-Ms": str(duration_ms)}
+            if overlay:
+                headers["X-Overlay-Box"] = ",".join(str(box[k]) for k in ("x", "y", "width", "height"))
+            return Response(content=video_data, media_type="video/mp4", headers=headers)
+
         video_base64 = base64.b64encode(video_data).decode('utf-8')
         
-        # Cleanup
-        try:
-            os.unlink(img_path)
-            os.unlink(aud_path)
-            os.unlink(output_path)
-        except Exception as e:
-            logger.warning(f"Cleanup failed: {e}")
-        
-        logger.info("Lip-sync video generated successfully")
-        return {
+        result = {
             "video": video_base64,
-            "duration_ms": len(video_data) // 1000  # Rough estimate
+            "duration_ms": duration_ms
         }
+        if overlay:
+            result["box"] = box
+        return result
     
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=504, detail="Processing timeout (>60s)")
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
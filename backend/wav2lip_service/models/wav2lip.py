@@ -93,36 +93,44 @@ class Wav2Lip(nn.Module):
             audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
             face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
 
-        audio_embedding = self.audio_encoder(audio_sequences) # B, 512, 1, 1
+        x = self.decode(audio_sequences, self.encode_face(face_sequences))
 
+        if input_dim_size > 4:
+            x = torch.split(x, B, dim=0) # [(B, C, H, W)]
+            outputs = torch.stack(x, dim=2) # (B, C, T, H, W)
+
+        else:
+            outputs = x
+            
+        return outputs
+
+    def encode_face(self, face_sequences):
+        """Run the face encoder on (N, 6, 96, 96) inputs.
+
+        Returns the list of skip features the decoder consumes. For a static
+        avatar they are the same for every frame, so they can be computed once
+        (N = 1) and passed to ``decode`` for every audio batch.
+        """
         feats = []
         x = face_sequences
         for f in self.face_encoder_blocks:
             x = f(x)
             feats.append(x)
+        return feats
 
-        x = audio_embedding
-        for f in self.face_decoder_blocks:
-            x = f(x)
-            try:
-                x = torch.cat((x, feats[-1]), dim=1)
-            except Exception as e:
-                print(x.size())
-                print(feats[-1].size())
-                raise e
-            
-            feats.pop()
+    def decode(self, audio_sequences, face_feats):
+        """Generate (B, 3, 96, 96) faces from (B, 1, 80, 16) mels and ``encode_face`` features.
 
-        x = self.output_block(x)
+        Features with a batch of 1 are broadcast over the audio batch.
+        """
+        x = self.audio_encoder(audio_sequences) # B, 512, 1, 1
+        B = x.size(0)
 
-        if input_dim_size > 4:
-            x = torch.split(x, B, dim=0) # [(B, C, H, W)]
-            outputs = torch.stack(x, dim=2) # (B, C, T, H, W)
+        for f, feat in zip(self.face_decoder_blocks, reversed(face_feats)):
+            x = f(x)
+            x = torch.cat((x, feat.expand(B, -1, -1, -1)), dim=1)
 
-        else:
-            outputs = x
-            
-        return outputs
+        return self.output_block(x)
 
 class Wav2Lip_disc_qual(nn.Module):
     def __init__(self):
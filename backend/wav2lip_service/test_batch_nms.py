@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Check that batch_nms keeps the same boxes with and without torchvision.
+
+Run with pytest or directly: python test_batch_nms.py
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from face_detection.detection.sfd import bbox
+
+
+def make_batch(num_boxes=400, num_images=4, seed=0):
+    """(num_boxes, num_images, 5) S3FD-style candidates: small, heavily overlapping boxes."""
+    rng = np.random.default_rng(seed)
+    # Fractional coordinates like the decoded S3FD boxes, so no IoU lands exactly on the threshold
+    x1 = rng.uniform(0, 40, size=(num_boxes, num_images)).astype(np.float32)
+    y1 = rng.uniform(0, 40, size=(num_boxes, num_images)).astype(np.float32)
+    # Small boxes make the +1 pixel convention change IoU noticeably
+    w = rng.uniform(2, 12, size=(num_boxes, num_images)).astype(np.float32)
+    h = rng.uniform(2, 12, size=(num_boxes, num_images)).astype(np.float32)
+    scores = rng.random((num_boxes, num_images)).astype(np.float32)
+    return np.stack([x1, y1, x1 + w, y1 + h, scores], axis=-1)
+
+
+def reference_nms(bboxlists, thresh, score_thresh=0.5):
+    """Per-image ``bbox.nms``, the baseline batch_nms must match."""
+    results = []
+    for i in range(bboxlists.shape[1]):
+        dets = bboxlists[:, i]
+        dets = dets[dets[:, 4] > score_thresh]
+        results.append(dets[bbox.nms(dets, thresh)])
+    return results
+
+
+def test_batch_nms_paths_match():
+    bboxlists = make_batch()
+    expected = reference_nms(bboxlists, 0.3)
+
+    numpy_path = bbox.tv_batched_nms
+    bbox.tv_batched_nms = None
+    try:
+        numpy_result = bbox.batch_nms(bboxlists, 0.3)
+    finally:
+        bbox.tv_batched_nms = numpy_path
+    for got, want in zip(numpy_result, expected):
+        np.testing.assert_array_equal(got, want)
+
+    if bbox.tv_batched_nms is None:
+        print("torchvision not installed, only the NumPy path was checked")
+        return
+    torchvision_result = bbox.batch_nms(bboxlists, 0.3)
+    for got, want in zip(torchvision_result, expected):
+        np.testing.assert_array_equal(got, want)
+
+
+if __name__ == "__main__":
+    test_batch_nms_paths_match()
+    print("batch_nms: NumPy and torchvision paths keep the same boxes")
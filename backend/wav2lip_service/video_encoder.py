@@ -0,0 +1,155 @@
+"""
+Single-pass H.264 encoder backed by an ffmpeg subprocess.
+
+Raw BGR frames are streamed to ffmpeg over stdin and muxed with the audio
+track in one encode. By default the result is a fragmented MP4 read back
+from stdout, so no intermediate AVI or output file touches the disk.
+"""
+import os
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+
+# Fragmented MP4 can be written to a non-seekable pipe and still plays in browsers
+FRAGMENTED_MP4_FLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+
+class FFmpegEncoder:
+    """Encode BGR frames (plus an optional audio track) to MP4.
+
+    Args:
+        width, height: Frame size in pixels
+        fps: Frame rate of the written frames
+        audio_bytes: Encoded audio (WAV/MP3/...) to mux, passed to ffmpeg over a pipe
+        audio_path: Audio file to mux instead of ``audio_bytes``
+        output_path: Write a regular MP4 file here instead of returning fragmented MP4 bytes
+    """
+
+    def __init__(self, width, height, fps, audio_bytes=None, audio_path=None, output_path=None,
+                 preset="ultrafast"):
+        self.output_path = output_path
+        self._temp_audio_path = None
+        self._chunks = []
+        self._stderr = []
+        self._threads = []
+
+        cmd = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo",
+            "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}",
+            "-r", str(fps),
+            "-i", "pipe:0",
+        ]
+
+        audio_read_fd = audio_write_fd = None
+        if audio_path is None and audio_bytes is not None:
+            if os.name == "nt":
+                # Windows cannot hand extra pipe descriptors to ffmpeg
+                with tempfile.NamedTemporaryFile(suffix=".audio", delete=False) as f:
+                    f.write(audio_bytes)
+                    self._temp_audio_path = audio_path = f.name
+            else:
+                audio_read_fd, audio_write_fd = os.pipe()
+                cmd += ["-i", f"pipe:{audio_read_fd}"]
+        if audio_path is not None:
+            cmd += ["-i", str(audio_path)]
+        has_audio = audio_path is not None or audio_read_fd is not None
+
+        cmd += [
+            "-c:v", "libx264",  # H.264 codec for browser compatibility
+            # yuv420p needs even frame dimensions
+            "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+            "-preset", preset,
+            "-pix_fmt", "yuv420p",
+        ]
+        if has_audio:
+            cmd += ["-c:a", "aac", "-b:a", "128k"]
+        if output_path is not None:
+            cmd += ["-movflags", "+faststart", str(output_path)]
+        else:
+            cmd += ["-f", "mp4", "-movflags", FRAGMENTED_MP4_FLAGS, "pipe:1"]
+
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE if output_path is None else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            pass_fds=(audio_read_fd,) if audio_read_fd is not None else (),
+        )
+
+        if audio_read_fd is not None:
+            os.close(audio_read_fd)
+            self._start(self._feed_audio, audio_write_fd, audio_bytes)
+        if output_path is None:
+            self._start(self._drain, self.process.stdout, self._chunks)
+        self._start(self._drain, self.process.stderr, self._stderr)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    @staticmethod
+    def _feed_audio(fd, data):
+        try:
+            with os.fdopen(fd, "wb") as pipe:
+                pipe.write(data)
+        except OSError:
+            # ffmpeg exited early; the error is reported from finish()
+            pass
+
+    @staticmethod
+    def _drain(stream, chunks):
+        for chunk in iter(lambda: stream.read(65536), b""):
+            chunks.append(chunk)
+
+    def write(self, frames):
+        """Write one (H, W, 3) frame or a (N, H, W, 3) batch of uint8 BGR frames."""
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frames, dtype=np.uint8).data)
+        except OSError:
+            self._wait()
+            raise RuntimeError(f"ffmpeg exited early: {self._error_output()}")
+
+    def finish(self):
+        """Flush the encoder and return the MP4 bytes (None when writing to ``output_path``)."""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self._wait()
+        if self.process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {self._error_output()}")
+        if self.output_path is None:
+            return b"".join(self._chunks)
+        return None
+
+    def abort(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self._wait()
+
+    def _wait(self):
+        self.process.wait()
+        for thread in self._threads:
+            thread.join()
+        if self._temp_audio_path and os.path.exists(self._temp_audio_path):
+            os.remove(self._temp_audio_path)
+            self._temp_audio_path = None
+
+    def _error_output(self):
+        return b"".join(self._stderr).decode("utf-8", errors="replace").strip()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()